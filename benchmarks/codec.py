@@ -0,0 +1,72 @@
+import argparse
+import sys
+import time
+
+from chpoker.jsonencoder import dumps_json, dumps_orjson, orjson
+from chpoker.messagecodec import JSONCodec, MsgpackCodec, msgpack
+from chpoker.models.identity import DebugIdentity
+from chpoker.models.user import IdentityUser, Session
+from chpoker.pokerservice import PokerService
+
+
+def build_users(size):
+    users = []
+
+    for n in range(size):
+        user = IdentityUser(identity=DebugIdentity(id="user_%d" % n, first_name="User %d" % n, last_name="Benchmark"))
+        user.add_session(Session())
+        user.score = n % 13
+        users.append(user)
+
+    return users
+
+
+def measure(operation, duration):
+    ops = 0
+    started = time.perf_counter()
+
+    while time.perf_counter() - started < duration:
+        for _ in range(10):
+            operation()
+
+        ops += 10
+
+    return ops / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="chpoker wire format benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100, 1000], help="users per event")
+    parser.add_argument("--duration", type=float, default=0.5, help="seconds per measurement")
+    args = parser.parse_args()
+
+    if not msgpack:
+        sys.exit("msgpack is not installed")
+
+    codecs = {
+        "json": JSONCodec(dumps_json),
+        "msgpack": MsgpackCodec({PokerService.__name__: list(PokerService.Events)}),
+    }
+
+    if orjson:
+        codecs["orjson"] = JSONCodec(dumps_orjson)
+
+    print("%8s %8s %14s %16s" % ("users", "codec", "frame bytes", "encodes/s"))
+
+    for size in args.sizes:
+        users = build_users(size)
+        event_data = {
+            "service": PokerService.__name__,
+            "name": str(PokerService.Events.USERS_UPDATED),
+            "arguments": (users,)
+        }
+
+        for name, codec in codecs.items():
+            frame = codec.encode_event(event_data)
+            rate = measure(lambda: codec.encode_event(event_data), args.duration)
+
+            print("%8d %8s %14d %16.0f" % (size, name, len(frame), rate))
+
+
+if __name__ == "__main__":
+    main()
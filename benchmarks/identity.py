@@ -0,0 +1,51 @@
+import argparse
+import time
+
+from chpoker.identity import IdentitySigner
+from chpoker.models.identity import Identity
+
+
+def measure(operation, duration):
+    ops = 0
+    started = time.perf_counter()
+
+    while time.perf_counter() - started < duration:
+        for _ in range(100):
+            operation()
+
+        ops += 100
+
+    return ops / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="chpoker identity token benchmark")
+    parser.add_argument("--duration", type=float, default=1.0, help="seconds per measurement")
+    args = parser.parse_args()
+
+    signer = IdentitySigner(b"0" * IdentitySigner.KEY_SIZE, cache_size=0)
+    identity = Identity(
+        id="jane.doe@example.com",
+        first_name="Jane",
+        last_name="Doe",
+        display_name="Jane D.",
+        can_moderate=True
+    )
+
+    formats = {
+        "pickle": lambda: signer.sign_object(identity.__dict__),
+        "binary": lambda: signer.encode_token(identity),
+    }
+
+    print("%8s %12s %16s %16s" % ("format", "token bytes", "sign ops/s", "verify ops/s"))
+
+    for name, sign in formats.items():
+        token = sign()
+        sign_rate = measure(sign, args.duration)
+        verify_rate = measure(lambda: signer.unsign_identity(token), args.duration)
+
+        print("%8s %12d %16.0f %16.0f" % (name, len(token), sign_rate, verify_rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import argparse
+import asyncio
+import json
+import shutil
+import tempfile
+import time
+
+from chpoker.clientnotificationservice import ClientNotificationService
+from chpoker.identity import DebugIdentitySigner
+from chpoker.journal import Journal, FsyncPolicy
+from chpoker.pokerservice import PokerService
+
+
+async def discard_event(client_id, event_data):
+    pass
+
+
+def create_service(journal=None):
+    notification_service = ClientNotificationService(service_name=PokerService.__name__, on_event=discard_event)
+    return PokerService(notification_service=notification_service, identity_signer=DebugIdentitySigner(), journal=journal)
+
+
+async def connect(service, session_id, user_id, can_moderate=False):
+    identity = json.dumps({"id": user_id, "first_name": "User", "last_name": "Benchmark", "can_moderate": can_moderate})
+    await service.on_connected(session_id, {"identity": identity, "room": "benchmark"})
+
+
+async def fill_room(service, voters):
+    session_ids = ["voter_%d" % n for n in range(voters)]
+
+    for n, session_id in enumerate(session_ids):
+        await connect(service, session_id, "user_%d" % n)
+        await service.login_voter(session_id)
+
+    return session_ids
+
+
+async def measure_votes(journal, voters, rounds):
+    service = create_service(journal)
+    session_ids = await fill_room(service, voters)
+
+    await connect(service, "host", "host", can_moderate=True)
+    await service.login_host("host")
+
+    started = time.perf_counter()
+
+    for n in range(rounds):
+        for session_id in session_ids:
+            await service.estimate_target(session_id, n % 5 + 1)
+
+        await service.new_target("host")
+
+    elapsed = time.perf_counter() - started
+    await service.stop()
+
+    return elapsed / (rounds * len(session_ids))
+
+
+async def measure_recovery(path, records):
+    journal = Journal(path, fsync=FsyncPolicy.NEVER, snapshot_interval=2 * records)
+    service = create_service(journal)
+    session_ids = await fill_room(service, 20)
+
+    await connect(service, "host", "host", can_moderate=True)
+    await service.login_host("host")
+
+    while journal.records < records:
+        for session_id in session_ids:
+            await service.estimate_target(session_id, journal.records % 5 + 1)
+
+        await service.new_target("host")
+
+    await service.stop()
+
+    started = time.perf_counter()
+    recovered = create_service(Journal(path))
+    await recovered.start()
+    replay_time = time.perf_counter() - started
+
+    recovered.journal.write_snapshot(recovered.dump_state())
+
+    started = time.perf_counter()
+    await create_service(Journal(path)).start()
+    snapshot_time = time.perf_counter() - started
+
+    return replay_time, snapshot_time
+
+
+async def run(args):
+    print("%10s %16s" % ("fsync", "us/vote"))
+
+    baseline = await measure_votes(None, args.voters, args.rounds)
+    print("%10s %16.1f" % ("disabled", baseline * 1e6))
+
+    for policy in FsyncPolicy:
+        path = tempfile.mkdtemp()
+
+        try:
+            per_vote = await measure_votes(Journal(path, fsync=policy), args.voters, args.rounds)
+        finally:
+            shutil.rmtree(path)
+
+        print("%10s %16.1f" % (policy, per_vote * 1e6))
+
+    print()
+    print("%10s %16s %16s" % ("records", "replay s", "snapshot s"))
+
+    for records in args.records:
+        path = tempfile.mkdtemp()
+
+        try:
+            replay_time, snapshot_time = await measure_recovery(path, records)
+        finally:
+            shutil.rmtree(path)
+
+        print("%10d %16.3f %16.3f" % (records, replay_time, snapshot_time))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="chpoker journal benchmark")
+    parser.add_argument("--voters", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--records", type=int, nargs="+", default=[10000, 100000, 1000000])
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
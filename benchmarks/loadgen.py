@@ -0,0 +1,265 @@
+import argparse
+import asyncio
+import importlib.metadata
+import json
+import random
+import resource
+import statistics
+import time
+from datetime import datetime
+
+import aiohttp
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def server_rss(pid):
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, TypeError):
+        return None
+
+
+class Stats:
+
+    def __init__(self):
+        self.latencies = []
+        self.pending_votes = {}
+        self.sent = 0
+        self.received = 0
+        self.votes = 0
+        self.rounds = 0
+        self.reveal_timeouts = 0
+        self.reconnects = 0
+        self.errors = 0
+
+
+class Client:
+
+    def __init__(self, session, args, stats, room_id, user_id, can_moderate=False):
+        self.session = session
+        self.args = args
+        self.stats = stats
+        self.room_id = room_id
+        self.identity = json.dumps({
+            "id": user_id,
+            "first_name": "Load",
+            "last_name": user_id,
+            "can_moderate": can_moderate
+        })
+        self.socket = None
+        self.reader = None
+        self.user_id = None
+        self.logged_in = asyncio.Event()
+        self.new_target = asyncio.Event()
+        self.scores_revealed = asyncio.Event()
+
+    async def connect(self):
+        self.socket = await self.session.ws_connect(self.args.url)
+        await self.send({"type": "hello", "room": self.room_id, "identity": self.identity})
+        await self.socket.receive_json()
+
+        self.reader = asyncio.create_task(self.read_messages())
+
+    async def close(self):
+        await self.socket.close()
+        await self.reader
+
+    async def send(self, message):
+        await self.socket.send_str(json.dumps(message))
+        self.stats.sent += 1
+
+    async def rpc(self, method, **params):
+        await self.send({"type": "rpc", "rpc": {"service": "PokerService", "method": method, "params": params}})
+
+    async def read_messages(self):
+        async for message in self.socket:
+            if message.type != aiohttp.WSMsgType.TEXT:
+                continue
+
+            self.stats.received += 1
+            body = json.loads(message.data)
+
+            if body["type"] == "event":
+                self.on_event(body["event"]["name"], body["event"]["arguments"])
+
+    def on_event(self, name, arguments):
+        if name == "profile_updated":
+            self.user_id = arguments[0]["id"]
+        elif name in ("logged_in_voter", "logged_in_host"):
+            self.logged_in.set()
+        elif name == "new_target":
+            self.new_target.set()
+        elif name == "scores_revealed":
+            self.scores_revealed.set()
+        elif name == "updated_user":
+            self.on_users_updated(arguments[0:1])
+        elif name == "users_updated":
+            self.on_users_updated(arguments[0])
+
+    def on_users_updated(self, users):
+        received_at = time.perf_counter()
+
+        for user in users:
+            if not user["score"]:
+                continue
+
+            try:
+                sent_at = self.stats.pending_votes.pop(user["id"])
+            except KeyError:
+                continue
+
+            self.stats.latencies.append(received_at - sent_at)
+
+    async def login(self, method):
+        # calls of different connections are not ordered, so wait for the server to confirm
+        await self.rpc(method)
+        await self.logged_in.wait()
+
+    async def vote(self, score):
+        self.stats.pending_votes[self.user_id] = time.perf_counter()
+        self.stats.votes += 1
+        await self.rpc("estimate_target", score=score)
+
+
+async def run_room(session, args, stats, room_number, connect_slots):
+    room_id = "load_%d" % room_number
+    rng = random.Random(room_number)
+
+    async def connect(client):
+        async with connect_slots:
+            await client.connect()
+
+    host = Client(session, args, stats, room_id, "%s_host" % room_id, can_moderate=True)
+    voters = [Client(session, args, stats, room_id, "%s_voter_%d" % (room_id, n)) for n in range(args.room_size)]
+
+    await asyncio.gather(*(connect(client) for client in [host] + voters))
+    await host.login("login_host")
+    await asyncio.gather(*(voter.login("login_voter") for voter in voters))
+
+    async def vote(voter):
+        await voter.new_target.wait()
+        await asyncio.sleep(rng.uniform(0, args.think_time))
+        await voter.vote(rng.randint(1, 13))
+
+    for _ in range(args.rounds):
+        for n, voter in enumerate(voters):
+            if rng.random() < args.churn:
+                await voter.close()
+                voters[n] = voter = Client(session, args, stats, room_id, "%s_voter_%d" % (room_id, n))
+                await connect(voter)
+                await voter.login("login_voter")
+                stats.reconnects += 1
+
+        for client in [host] + voters:
+            client.new_target.clear()
+            client.scores_revealed.clear()
+
+        await host.rpc("new_target")
+        await asyncio.gather(*(vote(voter) for voter in voters))
+
+        try:
+            await asyncio.wait_for(host.scores_revealed.wait(), args.reveal_timeout)
+        except asyncio.TimeoutError:
+            stats.reveal_timeouts += 1
+            await host.rpc("reveal_scores")
+
+        stats.rounds += 1
+
+    for client in [host] + voters:
+        await client.close()
+
+
+async def run(args):
+    stats = Stats()
+    connect_slots = asyncio.Semaphore(args.connect_concurrency)
+    rss_before = server_rss(args.server_pid)
+
+    # every websocket holds a connection, so the connector must not limit them
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        started = time.perf_counter()
+        results = await asyncio.gather(*(run_room(session, args, stats, n, connect_slots) for n in range(args.rooms)),
+                                       return_exceptions=True)
+        elapsed = time.perf_counter() - started
+
+    for result in results:
+        if isinstance(result, Exception):
+            stats.errors += 1
+            print("room failed: %r" % result)
+
+    try:
+        version = importlib.metadata.version("chpoker")
+    except importlib.metadata.PackageNotFoundError:
+        version = None
+
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "version": version,
+        "parameters": vars(args),
+        "results": {
+            "duration": elapsed,
+            "clients": args.rooms * (args.room_size + 1),
+            "rounds": stats.rounds,
+            "votes": stats.votes,
+            "reconnects": stats.reconnects,
+            "reveal_timeouts": stats.reveal_timeouts,
+            "room_errors": stats.errors,
+            "messages_sent": stats.sent,
+            "messages_received": stats.received,
+            "messages_per_second": (stats.sent + stats.received) / elapsed,
+            "vote_latency": {
+                "samples": len(stats.latencies),
+                "mean": statistics.mean(stats.latencies) if stats.latencies else None,
+                "p50": percentile(stats.latencies, 0.50),
+                "p95": percentile(stats.latencies, 0.95),
+                "p99": percentile(stats.latencies, 0.99),
+            },
+            "loadgen_max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "server_rss_before": rss_before,
+            "server_rss_after": server_rss(args.server_pid),
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="chpoker websocket load generator, run against chpoker --debug-identity")
+    parser.add_argument("--url", default="ws://localhost:8080/ws")
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--room-size", type=int, default=20, help="voters per room, each room also has a host")
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--churn", type=float, default=0.05, help="chance of a voter reconnecting before a round")
+    parser.add_argument("--think-time", type=float, default=0.5, help="maximum seconds before a voter votes")
+    parser.add_argument("--reveal-timeout", type=float, default=10)
+    parser.add_argument("--connect-concurrency", type=int, default=50)
+    parser.add_argument("--server-pid", type=int, help="report the memory of the server process")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    results = report["results"]
+    latency = results["vote_latency"]
+
+    print("%d clients, %d rounds, %d votes in %.1fs" % (results["clients"], results["rounds"], results["votes"], results["duration"]))
+    print("%.0f messages/s, %d reconnects, %d reveal timeouts, %d failed rooms" % (
+        results["messages_per_second"], results["reconnects"], results["reveal_timeouts"], results["room_errors"]))
+
+    if latency["samples"]:
+        print("vote to host latency: p50 %.1fms, p95 %.1fms, p99 %.1fms" % (
+            latency["p50"] * 1000, latency["p95"] * 1000, latency["p99"] * 1000))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
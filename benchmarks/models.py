@@ -0,0 +1,95 @@
+import argparse
+import gc
+import time
+import tracemalloc
+
+from chpoker.models.identity import DebugIdentity
+from chpoker.models.room import Room
+from chpoker.models.user import IdentityUser, Session, SessionType
+
+
+def build_room(size):
+    room = Room(id="benchmark")
+
+    for n in range(size):
+        identity = DebugIdentity(id="user_%d" % n, first_name="User", last_name="Benchmark")
+        user = IdentityUser(identity=identity)
+        room.add_user(user)
+        room.add_session(Session(user=user))
+
+    return room
+
+
+def measure_memory(size):
+    gc.collect()
+    tracemalloc.start()
+    room = build_room(size)
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return allocated / len(room.sessions_by_id)
+
+
+def measure_ops(room, operation, duration):
+    sessions = list(room.sessions_by_id.values())
+    ops = 0
+    started = time.perf_counter()
+
+    while time.perf_counter() - started < duration:
+        for session in sessions:
+            operation(room, session)
+
+        ops += len(sessions)
+
+    return ops / (time.perf_counter() - started)
+
+
+def toggle_type(room, session):
+    room.set_session_type(session, SessionType.NONE if session.voter else SessionType.VOTER)
+
+
+def toggle_connected(room, session):
+    session.connected = not session.connected
+
+
+def vote(room, session):
+    with room.tracking(session.user):
+        session.user.score = 0 if session.user.score else 3
+
+
+def read_flags(room, session):
+    user = session.user
+    return user.voting, user.hosting, user.active, user.connected
+
+
+def serialize(room, session):
+    return dict(session.user)
+
+
+OPERATIONS = {
+    "retype": toggle_type,
+    "connectivity": toggle_connected,
+    "vote": vote,
+    "flags": read_flags,
+    "serialize": serialize,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="chpoker model benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--duration", type=float, default=0.5, help="seconds per measurement")
+    args = parser.parse_args()
+
+    print("%8s %16s" % ("size", "bytes/session") + "".join("%20s" % ("%s ops/s" % name) for name in OPERATIONS))
+
+    for size in args.sizes:
+        bytes_per_session = measure_memory(size)
+        room = build_room(size)
+        rates = [measure_ops(room, operation, args.duration) for operation in OPERATIONS.values()]
+
+        print("%8d %16.0f" % (size, bytes_per_session) + "".join("%20.0f" % rate for rate in rates))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+from chpoker.clientnotificationservice import ClientNotificationService
+from chpoker.identity import DebugIdentitySigner
+from chpoker.pokerservice import PokerService
+
+
+class RecordingTransport:
+
+    def __init__(self):
+        self.events = 0
+
+    async def on_event(self, client_id, event_data):
+        self.events += 1
+
+
+def identity(user_id, can_moderate=False):
+    return json.dumps({"id": user_id, "first_name": "User", "last_name": user_id, "can_moderate": can_moderate})
+
+
+def create_service(transport):
+    notification_service = ClientNotificationService(service_name=PokerService.__name__, on_event=transport.on_event)
+    return PokerService(notification_service=notification_service, identity_signer=DebugIdentitySigner())
+
+
+async def connect(service, session_id, can_moderate=False):
+    await service.on_connected(session_id, {"identity": identity(session_id, can_moderate), "room": "benchmark"})
+
+
+async def build_room(service, size, hosts=1):
+    voters = ["voter_%d" % n for n in range(size)]
+
+    for n in range(hosts):
+        await connect(service, "host_%d" % n, can_moderate=True)
+        await service.login_host("host_%d" % n)
+
+    for session_id in voters:
+        await connect(service, session_id)
+        await service.login_voter(session_id)
+
+    return voters
+
+
+# every scenario prepares a service and returns the operations to time
+
+async def scenario_connect(service, size, churn):
+    await build_room(service, 0)
+    return [lambda n=n: connect(service, "voter_%d" % n) for n in range(size)]
+
+
+async def scenario_login_voter(service, size, churn):
+    await build_room(service, 0)
+
+    for n in range(size):
+        await connect(service, "voter_%d" % n)
+
+    return [lambda n=n: service.login_voter("voter_%d" % n) for n in range(size)]
+
+
+async def scenario_login_host(service, size, churn):
+    await build_room(service, size, hosts=0)
+    hosts = ["host_%d" % n for n in range(10)]
+
+    for session_id in hosts:
+        await connect(service, session_id, can_moderate=True)
+
+    return [lambda session_id=session_id: service.login_host(session_id) for session_id in hosts]
+
+
+async def scenario_vote(service, size, churn):
+    voters = await build_room(service, size)
+    return [lambda session_id=session_id: service.estimate_target(session_id, 3) for session_id in voters]
+
+
+async def scenario_reveal(service, size, churn):
+    voters = await build_room(service, size)
+
+    for session_id in voters[:-1]:
+        await service.estimate_target(session_id, 3)
+
+    room = service.rooms_by_id["benchmark"]
+    return [lambda: service._reveal_scores(room) for _ in range(20)]
+
+
+async def scenario_round(service, size, churn):
+    voters = await build_room(service, size)
+    rng = random.Random(size)
+
+    async def play_round():
+        for session_id in voters:
+            if rng.random() < churn:
+                await service.on_disconnected(session_id)
+                await connect(service, session_id)
+
+        await service.new_target("host_0")
+
+        for session_id in voters:
+            await service.estimate_target(session_id, 3)
+
+    return [play_round for _ in range(5)]
+
+
+async def scenario_expire(service, size, churn):
+    voters = await build_room(service, size)
+
+    for session_id in voters:
+        await service.on_disconnected(session_id)
+
+    async def expire(session_id):
+        service.session_expiry.cancel(session_id)
+        service.expire_session(session_id)
+
+    return [lambda session_id=session_id: expire(session_id) for session_id in voters]
+
+
+SCENARIOS = {
+    "connect": scenario_connect,
+    "login_voter": scenario_login_voter,
+    "login_host": scenario_login_host,
+    "vote": scenario_vote,
+    "reveal": scenario_reveal,
+    "round": scenario_round,
+    "expire": scenario_expire,
+}
+
+
+async def measure(scenario, size, churn, trace_memory=False):
+    transport = RecordingTransport()
+    service = create_service(transport)
+    operations = await scenario(service, size, churn)
+    transport.events = 0
+
+    if trace_memory:
+        tracemalloc.start()
+
+    started = time.perf_counter()
+
+    for operation in operations:
+        await operation()
+
+    elapsed = time.perf_counter() - started
+
+    peak = 0
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        "ops_per_second": len(operations) / elapsed,
+        "events_per_op": transport.events / len(operations),
+        "peak_bytes_per_op": peak / len(operations),
+    }
+
+
+async def run(args):
+    results = {}
+
+    for name in args.scenarios:
+        for size in args.sizes:
+            runs = [await measure(SCENARIOS[name], size, args.churn) for _ in range(args.repeat)]
+            result = max(runs, key=lambda r: r["ops_per_second"])
+            result["peak_bytes_per_op"] = (await measure(SCENARIOS[name], size, args.churn, trace_memory=True))["peak_bytes_per_op"]
+
+            results["%s/%d" % (name, size)] = result
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+
+    for key, result in results.items():
+        try:
+            previous = baseline[key]
+        except KeyError:
+            continue
+
+        if result["ops_per_second"] < previous["ops_per_second"] * (1 - threshold):
+            regressions.append("%s: %.0f ops/s, was %.0f" % (key, result["ops_per_second"], previous["ops_per_second"]))
+
+        if result["events_per_op"] > previous["events_per_op"] * (1 + threshold):
+            regressions.append("%s: %.1f events/op, was %.1f" % (key, result["events_per_op"], previous["events_per_op"]))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="chpoker PokerService benchmark")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000], help="voters per room")
+    parser.add_argument("--churn", type=float, default=0.1, help="chance of a voter reconnecting before a round")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, the best one is kept")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.25, help="relative slowdown that fails the comparison")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+
+    print("%-20s %14s %14s %18s" % ("scenario", "ops/s", "events/op", "peak bytes/op"))
+    for key, result in results.items():
+        print("%-20s %14.0f %14.1f %18.0f" % (key, result["ops_per_second"], result["events_per_op"], result["peak_bytes_per_op"]))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+
+        for regression in regressions:
+            print("regression: %s" % regression)
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import argparse
+import asyncio
+import gc
+import itertools
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+import aiohttp
+import aiohttp.web
+
+from chpoker.clientnotificationservice import ClientNotificationService
+from chpoker.identity import DebugIdentitySigner
+from chpoker.pokerservice import PokerService
+from chpoker.webserver import WebServer
+from chpoker.websocketrpcprotocol import WebSocketRPCProtocol
+
+
+def create_server(args):
+    rpc_protocol = WebSocketRPCProtocol(heartbeat_interval=args.heartbeat_interval, rate_limits={})
+    notification_service = ClientNotificationService(
+        service_name=PokerService.__name__,
+        on_event=rpc_protocol.send_event,
+        on_broadcast=rpc_protocol.broadcast_event)
+    pokerservice = PokerService(
+        notification_service=notification_service,
+        identity_signer=DebugIdentitySigner(),
+        session_grace_period=args.grace_period
+    )
+    rpc_protocol.register_service(pokerservice, {"login_voter", "estimate_target"}, events=PokerService.Events)
+
+    webserver = WebServer()
+    webserver.add_protocol("ws", rpc_protocol)
+
+    return webserver, rpc_protocol, pokerservice
+
+
+async def cycle(session, url, args, rng, client_id):
+    socket = await session.ws_connect(url, autoping=False)
+    identity = json.dumps({"id": client_id, "first_name": "Soak", "last_name": client_id, "can_moderate": False})
+
+    await socket.send_json({"type": "hello", "client_id": client_id, "room": "soak_%d" % rng.randrange(args.rooms),
+                            "identity": identity})
+    await socket.receive_json()
+
+    for method, params in (("login_voter", {}), ("estimate_target", {"score": 3})):
+        await socket.send_json({"type": "rpc", "rpc": {"service": "PokerService", "method": method, "params": params}})
+
+    if rng.random() < args.vanish:
+        # stop reading and answering pings without closing, like a peer that lost its network
+        await asyncio.sleep(args.heartbeat_interval * 2)
+        await socket.close()
+        return True
+
+    await socket.close()
+    return False
+
+
+async def run(args):
+    webserver, rpc_protocol, pokerservice = create_server(args)
+    runner = aiohttp.web.AppRunner(webserver.app)
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = "http://127.0.0.1:%d/ws" % runner.addresses[0][1]
+
+    client_ids = itertools.count()
+    counts = {"cycles": 0, "vanished": 0, "errors": 0}
+    checkpoints = []
+
+    def checkpoint():
+        gc.collect()
+        current, _ = tracemalloc.get_traced_memory()
+        checkpoints.append({"cycles": counts["cycles"], "traced_memory": current,
+                            "clients": len(rpc_protocol.clients_by_id), **pokerservice.stats})
+        print("%(cycles)10d cycles %(traced_memory)12d bytes %(clients)6d clients %(sessions)6d sessions "
+              "%(rooms)4d rooms" % checkpoints[-1])
+
+    async def worker(n):
+        rng = random.Random(n)
+
+        async with aiohttp.ClientSession() as session:
+            while counts["cycles"] < args.cycles:
+                counts["cycles"] += 1
+
+                if counts["cycles"] % args.checkpoint_interval == 0:
+                    checkpoint()
+
+                # a small pool of ids makes clients reconnect into their still living sessions
+                client_id = "soak_%d" % (next(client_ids) % args.client_ids)
+
+                try:
+                    vanished = await cycle(session, url, args, rng, client_id)
+                except Exception as e:
+                    counts["errors"] += 1
+                    print("cycle failed: %r" % e)
+                else:
+                    counts["vanished"] += vanished
+
+    tracemalloc.start()
+    started = time.perf_counter()
+
+    await asyncio.gather(*(worker(n) for n in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    # everything still held must be released once heartbeats and session expiry catch up
+    await asyncio.sleep(args.heartbeat_interval + args.grace_period + 1)
+    checkpoint()
+
+    await runner.cleanup()
+    tracemalloc.stop()
+
+    return counts, checkpoints, elapsed, rpc_protocol.stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="chpoker connect/disconnect soak test")
+    parser.add_argument("--cycles", type=int, default=100000, help="connections to open and close")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--client-ids", type=int, default=10000, help="distinct client ids to cycle through")
+    parser.add_argument("--vanish", type=float, default=0.001, help="chance of a client disappearing without closing")
+    parser.add_argument("--heartbeat-interval", type=float, default=2)
+    parser.add_argument("--grace-period", type=float, default=2, help="seconds before disconnected sessions expire")
+    parser.add_argument("--checkpoint-interval", type=int, default=10000)
+    parser.add_argument("--max-growth", type=int, default=1024 * 1024,
+                        help="bytes traced memory may grow between the first and the last checkpoint")
+    args = parser.parse_args()
+
+    counts, checkpoints, elapsed, stats = asyncio.run(run(args))
+
+    print("%d cycles in %.1fs (%.0f/s), %d vanished, %d errors" % (
+        counts["cycles"], elapsed, counts["cycles"] / elapsed, counts["vanished"], counts["errors"]))
+    print("heartbeat timeouts %(heartbeat_timeouts)d, replaced connections %(replaced_connections)d" % stats)
+
+    failures = []
+    final = checkpoints[-1]
+    growth = final["traced_memory"] - checkpoints[0]["traced_memory"]
+
+    if growth > args.max_growth:
+        failures.append("traced memory grew by %d bytes" % growth)
+
+    for key in ("clients", "sessions", "rooms", "expiring_sessions"):
+        if final[key]:
+            failures.append("%d %s left after the run" % (final[key], key.replace("_", " ")))
+
+    for failure in failures:
+        print("failed: %s" % failure)
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,22 @@
+import functools
 import logging.config
+import os.path
+import tempfile
 
 from .config import Config
-from .webserver import WebServer
+from .webserver import WebServer, load_static_assets
 from .pokerservice import PokerService
 from .websocketrpcprotocol import WebSocketRPCProtocol
 from .clientnotificationservice import ClientNotificationService
-from .aiosaml import AiosamlApplication
+from .aiosaml import AiosamlApplication, ResponseParser
 from .identity import IdentitySigner, DebugIdentitySigner
+from .history import VoteHistory
+from .journal import Journal
+from .metrics import Metrics
+from .profiling import slow_callback_detection
+from .admin import AdminApplication
+from .backplane import Backplane
+from .cluster import ClusterRouter, run_workers
 
 
 def main():
@@ -43,40 +53,162 @@ def main():
                 "level": "DEBUG",
                 "handlers": ["console"],
                 "propagate": False,
+            },
+            "asyncio": {
+                "level": "DEBUG",
+                "handlers": ["console"],
+                "propagate": False,
             }
         }
     })
 
-    rpc_protocol = WebSocketRPCProtocol()
-    identity_signer = DebugIdentitySigner() if config.debug_identity else IdentitySigner(config.signing_key)
+    if config.workers == 1:
+        webserver = create_webserver(config)
+        webserver.run(host=config.host, port=config.port)
+        return
+
+    broker_path = None
+    backplane_url = config.backplane_url
+
+    if not backplane_url:
+        broker_path = os.path.join(tempfile.gettempdir(), "chpoker-%d.sock" % os.getpid())
+        backplane_url = "unix://%s" % broker_path
+
+    # generate the signing key and compress the static assets before forking so that all workers share them
+    config.signing_key
+    static_assets = load_static_assets()
+
+    run_workers(config.workers, functools.partial(run_worker, config, backplane_url, static_assets), broker_path)
+
+
+def create_webserver(config, worker_id=0, backplane_url=None, static_assets=None):
+    metrics = Metrics(const_labels={"worker": worker_id} if backplane_url else None)
+
+    rpc_protocol = WebSocketRPCProtocol(
+        send_queue_size=config.send_queue_size,
+        send_timeout=config.send_timeout,
+        overflow_policy=config.overflow_policy,
+        metrics=metrics,
+        slow_rpc_threshold=config.slow_handler_duration,
+        max_connections=config.max_connections,
+        max_room_connections=config.max_room_connections,
+        max_message_size=config.max_message_size,
+        rate_limits=config.rate_limits,
+        heartbeat_interval=config.heartbeat_interval,
+        handshake_timeout=config.handshake_timeout
+    )
+    identity_signer = DebugIdentitySigner() if config.debug_identity else IdentitySigner(
+        config.signing_key,
+        cache_size=config.identity_cache_size,
+        cache_ttl=config.identity_cache_ttl,
+        accept_legacy_tokens=config.accept_legacy_tokens
+    )
 
     poker_notification_service = ClientNotificationService(
         service_name=PokerService.__name__,
-        on_event=rpc_protocol.send_event)
+        on_event=rpc_protocol.send_event,
+        on_broadcast=rpc_protocol.broadcast_event)
+    journal = None
+    if config.journal_dir:
+        journal = Journal(
+            os.path.join(config.journal_dir, "worker-%d" % worker_id) if backplane_url else config.journal_dir,
+            fsync=config.journal_fsync,
+            fsync_interval=config.journal_fsync_interval,
+            snapshot_interval=config.journal_snapshot_interval
+        )
+
     pokerservice = PokerService(
         notification_service=poker_notification_service,
-        identity_signer=identity_signer
+        identity_signer=identity_signer,
+        session_grace_period=config.session_grace_period,
+        update_batch_delay=config.update_batch_delay,
+        event_log_size=config.event_log_size,
+        journal=journal,
+        metrics=metrics,
+        history=VoteHistory(config.history_dir, memory_rounds=config.history_memory_rounds)
     )
 
-    rpc_protocol.register_service(pokerservice, {
+    pokerservice_methods = {
         "login_voter",
         "login_host",
         "logout_user",
         "new_target",
         "estimate_target",
-        "reveal_scores"
-    })
+        "reveal_scores",
+        "get_history"
+    }
+
+    webserver = WebServer(static_assets)
+    webserver.app.on_startup.append(pokerservice.start)
+    webserver.app.on_cleanup.append(pokerservice.stop)
+
+    if backplane_url:
+        router = ClusterRouter(
+            service=pokerservice,
+            methods=pokerservice_methods,
+            protocol=rpc_protocol,
+            backplane=Backplane(backplane_url),
+            worker_id=worker_id,
+            workers=config.workers
+        )
+        poker_notification_service.on_event = router.send_event
+        poker_notification_service.on_broadcast = router.broadcast_event
+
+        rpc_protocol.register_service(router, pokerservice_methods, events=PokerService.Events,
+                                      service_name=PokerService.__name__)
+        webserver.app.on_startup.append(router.start)
+        webserver.app.on_cleanup.append(router.stop)
+        history_page = router.history_page
+    else:
+        rpc_protocol.register_service(pokerservice, pokerservice_methods, events=PokerService.Events)
+        history_page = pokerservice.history_page
 
-    webserver = WebServer()
     webserver.add_protocol("ws", rpc_protocol)
+    webserver.add_metrics(metrics)
+
+    if config.slow_handler_duration is not None:
+        webserver.app.on_startup.append(slow_callback_detection(config.slow_handler_duration))
 
     aiosaml_application = AiosamlApplication(
         base_url=config.base_url,
         idp_metadata_urls=config.idp_metadata_urls,
         sp_config=config.sp_config,
         create_identity=identity_signer.sign_identity,
-        pysaml_debug=config.debug
+        pysaml_debug=config.debug,
+        metadata_refresh_interval=config.idp_metadata_refresh_interval,
+        metadata_cache_dir=config.idp_metadata_cache_dir,
+        response_parser=ResponseParser(
+            executor_type=config.acs_executor,
+            workers=config.acs_workers,
+            max_pending=config.acs_max_pending
+        )
     )
     webserver.app.add_subapp("/saml/", aiosaml_application)
 
-    webserver.run(host=config.host, port=config.port)
+    if config.admin_token:
+        webserver.app.add_subapp("/admin/", AdminApplication(
+            admin_token=config.admin_token,
+            history_page=history_page
+        ))
+
+    metrics.add_stats("websocket", lambda: rpc_protocol.stats,
+                      counters={"rejected_connections", "oversized_messages", "heartbeat_timeouts", "handshake_timeouts",
+                                "replaced_connections", "dropped_clients", "coalesced_messages", "send_timeouts",
+                                "send_failures"})
+    metrics.add_stats("poker", lambda: pokerservice.stats)
+    metrics.add_stats("history", lambda: pokerservice.history.stats, counters={"rounds", "spilled_rounds"})
+    metrics.add_stats("acs", lambda: aiosaml_application.response_parser.stats,
+                      counters={"parsed", "failed", "rejected"})
+
+    if isinstance(identity_signer, IdentitySigner):
+        metrics.add_stats("identity_cache", lambda: identity_signer.cache.stats, counters={"hits", "misses", "evictions"})
+
+    if journal:
+        metrics.add_stats("journal", lambda: journal.stats, counters={"records", "fsyncs", "snapshots"})
+
+    return webserver
+
+
+def run_worker(config, backplane_url, static_assets, worker_id):
+    webserver = create_webserver(config, worker_id=worker_id, backplane_url=backplane_url, static_assets=static_assets)
+    webserver.run(host=config.host, port=config.port, reuse_port=True)
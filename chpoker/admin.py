@@ -0,0 +1,86 @@
+import asyncio
+import logging
+from hmac import compare_digest
+
+from aiohttp import web
+
+from .cluster import RemoteError
+from .profiling import SamplingProfiler
+
+logger = logging.getLogger(__name__)
+
+routes = web.RouteTableDef()
+
+
+@web.middleware
+async def require_admin_token(request, handler):
+    authorization = request.headers.get("Authorization", "")
+    scheme, _, token = authorization.partition(" ")
+
+    if scheme.lower() != "bearer" or not compare_digest(token.encode(), request.app.admin_token.encode()):
+        raise web.HTTPUnauthorized(headers={"WWW-Authenticate": "Bearer"})
+
+    return await handler(request)
+
+
+class AdminApplication(web.Application):
+    def __init__(self, *args, admin_token, profiler=None, history_page=None, **kwargs):
+        super().__init__(*args, middlewares=[require_admin_token], **kwargs)
+
+        self.add_routes(routes)
+
+        self.admin_token = admin_token
+        self.profiler = profiler or SamplingProfiler()
+        # coroutine function (room_id, before, limit), the history is not exported without it
+        self.history_page = history_page
+
+        self.on_cleanup.append(self.stop_profiler)
+
+    async def stop_profiler(self, app):
+        self.profiler.stop()
+
+
+@routes.get("/profiler")
+async def profiler_status(request):
+    return web.json_response(request.app.profiler.status)
+
+
+@routes.post("/profiler/start")
+async def profiler_start(request):
+    request.app.profiler.start()
+    return web.json_response(request.app.profiler.status)
+
+
+@routes.post("/profiler/stop")
+async def profiler_stop(request):
+    request.app.profiler.stop()
+    return web.json_response(request.app.profiler.status)
+
+
+@routes.get("/profiler/stacks")
+async def profiler_stacks(request):
+    return web.Response(
+        text=request.app.profiler.render(),
+        content_type="text/plain",
+        headers={"Content-Disposition": 'attachment; filename="chpoker.folded"'}
+    )
+
+
+@routes.get("/history/{room}")
+async def history_page(request):
+    try:
+        before = int(request.query["before"]) if "before" in request.query else None
+        limit = int(request.query.get("limit", 20))
+    except ValueError:
+        raise web.HTTPBadRequest(text="before and limit must be integers")
+
+    if not request.app.history_page:
+        raise web.HTTPNotFound(text="the history is not available")
+
+    try:
+        page = await request.app.history_page(request.match_info["room"], before, limit)
+    except (RemoteError, asyncio.TimeoutError) as e:
+        logger.warning("error getting the history of room %s: %r", request.match_info["room"], e)
+        raise web.HTTPServiceUnavailable(text="the worker owning the room did not answer")
+
+    return web.json_response(page)
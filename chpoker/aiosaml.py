@@ -1,8 +1,15 @@
-import functools
+import asyncio
+import concurrent.futures
+import logging
+import multiprocessing
 import os.path
+import time
 from datetime import datetime
+from enum import StrEnum, auto, unique
+from hashlib import blake2b
 from urllib.parse import urljoin
 
+import aiohttp
 from aiohttp import web
 from saml2 import (
     BINDING_HTTP_POST,
@@ -16,11 +23,133 @@ from saml2.saml import NAME_FORMAT_BASIC
 
 from .models.identity import Identity
 
+logger = logging.getLogger(__name__)
+
 routes = web.RouteTableDef()
 
+# the client of a process pool worker, see init_response_parser_process
+process_saml_client = None
+
+
+def create_saml_client(settings):
+    config = Saml2Config()
+    config.load(settings)
+
+    return Saml2Client(config)
+
+
+def init_response_parser_process(settings):
+    global process_saml_client
+    process_saml_client = create_saml_client(settings)
+
+
+def parse_authn_response(saml_client, *response_args):
+    authn_response = (saml_client or process_saml_client).parse_authn_request_response(*response_args)
+    return authn_response.get_subject().text, authn_response.get_identity()
+
+
+@unique
+class ExecutorType(StrEnum):
+    THREAD = auto()
+    PROCESS = auto()
+
+
+class ResponseParser:
+
+    def __init__(self, executor_type=ExecutorType.THREAD, workers=4, max_pending=64):
+        self.executor_type = ExecutorType(executor_type)
+        self.workers = workers
+        self.max_pending = max_pending
+        self.executor = None
+        self.saml_client = None
+        self.slots = asyncio.Semaphore(workers)
+
+        self.pending = 0
+        self.running = 0
+        self.parsed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_time = 0
+        self.max_time = 0
+
+    @property
+    def stats(self):
+        return {
+            "executor": str(self.executor_type),
+            "workers": self.workers,
+            "queue_depth": self.pending - self.running,
+            "running": self.running,
+            "parsed": self.parsed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "mean_time": self.total_time / self.parsed if self.parsed else 0,
+            "max_time": self.max_time,
+        }
+
+    def update(self, saml_client, settings):
+        if self.executor_type == ExecutorType.THREAD:
+            self.saml_client = saml_client
+
+            if not self.executor:
+                self.executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="saml")
+
+            return
+
+        # the processes have their own clients, so they are replaced together with the metadata
+        previous_executor = self.executor
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_response_parser_process,
+            initargs=(settings,)
+        )
+
+        if previous_executor:
+            previous_executor.shutdown(wait=False)
+
+    def shutdown(self):
+        # waits for the pool, a worker process exiting right after would close its queue before the pool is stopped
+        if self.executor:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+    async def parse(self, *response_args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise web.HTTPServiceUnavailable(text="too many logins in progress", headers={"Retry-After": "1"})
+
+        self.pending += 1
+
+        started = time.perf_counter()
+
+        try:
+            async with self.slots:
+                self.running += 1
+
+                try:
+                    result = await asyncio.get_running_loop().run_in_executor(
+                        self.executor, parse_authn_response, self.saml_client, *response_args)
+                except Exception:
+                    self.failed += 1
+                    raise
+                finally:
+                    self.running -= 1
+
+                elapsed = time.perf_counter() - started
+                self.parsed += 1
+                self.total_time += elapsed
+                self.max_time = max(self.max_time, elapsed)
+
+                return result
+        finally:
+            self.pending -= 1
+
 
 class AiosamlApplication(web.Application):
-    def __init__(self, *args, base_url, idp_metadata_urls, sp_config, create_identity=None, pysaml_debug=False, **kwargs):
+    METADATA_TIMEOUT = 30
+    METADATA_RETRY_DELAY = 5
+
+    def __init__(self, *args, base_url, idp_metadata_urls, sp_config, create_identity=None, pysaml_debug=False,
+                 metadata_refresh_interval=3600, metadata_cache_dir=None, response_parser=None, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.add_routes(routes)
@@ -30,19 +159,188 @@ class AiosamlApplication(web.Application):
         self.sp_config = sp_config
         self.create_identity = create_identity
         self.pysaml_debug = pysaml_debug
+        self.metadata_refresh_interval = metadata_refresh_interval
+        self.metadata_cache_dir = metadata_cache_dir
+        self.response_parser = response_parser or ResponseParser()
+
+        # replaced as a whole on every refresh, requests keep using the previous one until then
+        self.saml_client = None
+        # a client without idps, serves the sp metadata until the first load
+        self.sp_saml_client = None
+        self.metadata_sources = {}
+        # last good document of every remote url, used when fetching it fails
+        self.metadata_documents = {}
+        self.metadata_refreshed_at = None
+        self.metadata_refresher = None
+
+        self.on_startup.append(self.start_metadata_refresh)
+        self.on_cleanup.append(self.stop_metadata_refresh)
+
+    @property
+    def remote_metadata_urls(self):
+        return [url for url in self.idp_metadata_urls if url.startswith("http")]
+
+    @property
+    def local_metadata_paths(self):
+        return [url for url in self.idp_metadata_urls if url.startswith("/")]
+
+    async def start_metadata_refresh(self, app):
+        if not self.idp_metadata_urls:
+            logger.warning("no idp metadata configured, logins are not possible")
+            return
+
+        # logins get a 503 until the first load succeeds, so the server does not wait for it
+        self.metadata_refresher = asyncio.create_task(self.refresh_metadata_periodically())
+
+    async def stop_metadata_refresh(self, app):
+        if self.metadata_refresher:
+            self.metadata_refresher.cancel()
 
-    @functools.cached_property
-    def saml_config(self):
+        await asyncio.to_thread(self.response_parser.shutdown)
+
+    async def refresh_metadata_periodically(self):
+        failures = 0
+
+        while True:
+            try:
+                complete = await self.refresh_metadata()
+            except Exception as e:
+                logger.exception("error refreshing idp metadata: %s", e)
+                complete = False
+
+            if complete and not self.remote_metadata_urls:
+                # local files are only read at startup
+                return
+
+            if complete:
+                failures = 0
+                delay = self.metadata_refresh_interval
+            else:
+                delay = min(self.METADATA_RETRY_DELAY * 2 ** failures, self.metadata_refresh_interval)
+                failures += 1
+                logger.info("retrying to load idp metadata in %gs", delay)
+
+            await asyncio.sleep(delay)
+
+    async def refresh_metadata(self):
+        # true when every idp was loaded from its source, false means retry soon
+        remote_urls = self.remote_metadata_urls
+        local_paths = self.local_metadata_paths
+
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.METADATA_TIMEOUT)) as session:
+            results = await asyncio.gather(*(self.fetch_metadata(session, url) for url in remote_urls))
+
+        documents = [document for document, _ in results if document]
+
+        if not documents and not local_paths:
+            logger.warning("no idp metadata could be loaded, keeping the current configuration")
+            return False
+
+        if self.saml_client and remote_urls and not any(fresh for _, fresh in results):
+            logger.warning("no idp metadata could be fetched, keeping the current configuration")
+            return False
+
+        settings = self.saml_settings(documents, local_paths)
+
+        try:
+            # parsing the metadata is too slow for the event loop
+            saml_client = await asyncio.to_thread(create_saml_client, settings)
+        except Exception as e:
+            logger.exception("error loading idp metadata: %s", e)
+            return False
+
+        self.response_parser.update(saml_client, settings)
+        self.saml_client = saml_client
+        self.metadata_refreshed_at = datetime.now()
+
+        logger.info("loaded idp metadata: %s", self.metadata_sources)
+        return all(fresh for _, fresh in results)
+
+    async def fetch_metadata(self, session, url):
+        # returns the document and whether it was fetched just now
+        cache_path = self.metadata_cache_path(url)
+
+        try:
+            async with session.get(url) as response:
+                response.raise_for_status()
+                document = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning("error fetching idp metadata from %s: %s", url, e)
+        else:
+            self.metadata_documents[url] = document
+            self.metadata_sources[url] = {"source": "remote", "fetched_at": datetime.now().isoformat()}
+
+            if cache_path:
+                try:
+                    await asyncio.to_thread(self.write_metadata_cache, cache_path, document)
+                except OSError as e:
+                    logger.warning("error caching idp metadata of %s: %s", url, e)
+
+            return document, True
+
+        if url in self.metadata_documents:
+            self.metadata_sources[url]["source"] = "memory"
+            return self.metadata_documents[url], False
+
+        if not cache_path:
+            return None, False
+
+        try:
+            document = await asyncio.to_thread(self.read_metadata_cache, cache_path)
+        except OSError:
+            return None, False
+
+        self.metadata_documents[url] = document
+        self.metadata_sources.setdefault(url, {"source": "cache", "fetched_at": None})["source"] = "cache"
+        return document, False
+
+    def metadata_cache_path(self, url):
+        if not self.metadata_cache_dir:
+            return None
+
+        return os.path.join(os.path.expanduser(self.metadata_cache_dir), blake2b(url.encode(), digest_size=16).hexdigest() + ".xml")
+
+    def write_metadata_cache(self, path, document):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path + ".tmp", "w") as f:
+            f.write(document)
+
+        os.replace(path + ".tmp", path)
+
+    def read_metadata_cache(self, path):
+        with open(path) as f:
+            return f.read()
+
+    async def get_sp_saml_client(self):
+        # the sp metadata does not depend on the idps, admins need it to register the sp before any idp is loaded
+        if self.saml_client:
+            return self.saml_client
+
+        if not self.sp_saml_client:
+            self.sp_saml_client = await asyncio.to_thread(create_saml_client, self.saml_settings([], []))
+
+        return self.sp_saml_client
+
+    @property
+    def metadata_status(self):
+        return {
+            "refreshed_at": self.metadata_refreshed_at and self.metadata_refreshed_at.isoformat(),
+            "refresh_interval": self.metadata_refresh_interval,
+            "sources": self.metadata_sources,
+            "acs": self.response_parser.stats,
+        }
+
+    def saml_settings(self, metadata_documents, metadata_paths):
         acs_url = urljoin(self.base_url, str(self.router["asc"].url_for()))
         metadata_url = urljoin(self.base_url, str(self.router["metadata"].url_for()))
 
-        config = Saml2Config()
-        config.load({
+        return {
             "debug": int(self.pysaml_debug),
             "entityid": "chpoker",
             "metadata": {
-                "remote": [{"url": url} for url in self.idp_metadata_urls if url.startswith("http")],
-                "local": [url for url in self.idp_metadata_urls if url.startswith("/")],
+                "inline": metadata_documents,
+                "local": metadata_paths,
             },
             "attribute_map_dir": os.path.join(os.path.dirname(__file__), "saml_attributes"),
             "service": {
@@ -71,21 +369,19 @@ class AiosamlApplication(web.Application):
             },
             "valid_for": 24 * 7,  # hours
             **self.sp_config
-        })
+        }
 
-        return config
 
-    @functools.cached_property
-    def saml_client(self):
-        return Saml2Client(self.saml_config)
+def get_saml_client(request):
+    if not request.app.saml_client:
+        raise web.HTTPServiceUnavailable(text="idp metadata is not loaded yet")
 
+    return request.app.saml_client
 
-async def assertion_consumer_service(request, *response_args):
-    saml_client = request.app.saml_client
-    authn_response = saml_client.parse_authn_request_response(*response_args)
-    identity = authn_response.get_identity()
 
-    identifier = authn_response.get_subject().text
+async def assertion_consumer_service(request, *response_args):
+    get_saml_client(request)
+    identifier, identity = await request.app.response_parser.parse(*response_args)
 
     response = web.Response(status=302, headers={"Location": "/"})
 
@@ -120,7 +416,14 @@ async def assertion_consumer_service_post(request):
 
 @routes.get("/metadata", name="metadata")
 async def metadata_service(request):
+    saml_client = await request.app.get_sp_saml_client()
+
     return web.Response(
-        body=create_metadata_string(None, config=request.app.saml_config),
+        body=create_metadata_string(None, config=saml_client.config),
         content_type="application/xml"
     )
+
+
+@routes.get("/status", name="status")
+async def status_service(request):
+    return web.json_response(request.app.metadata_status)
@@ -0,0 +1,229 @@
+import asyncio
+import logging
+import os
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+
+class BackplaneError(Exception):
+    pass
+
+
+def encode_bulk(part):
+    if isinstance(part, str):
+        part = part.encode()
+
+    return b"$%d\r\n%s\r\n" % (len(part), part)
+
+
+def encode_command(*parts):
+    return b"*%d\r\n" % len(parts) + b"".join(encode_bulk(part) for part in parts)
+
+
+async def read_reply(reader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionResetError("backplane connection closed")
+
+    prefix, value = line[:1], line[1:-2]
+
+    if prefix == b"+":
+        return value.decode()
+
+    if prefix == b"-":
+        raise BackplaneError(value.decode())
+
+    if prefix == b":":
+        return int(value)
+
+    if prefix == b"$":
+        length = int(value)
+        if length < 0:
+            return None
+
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+
+    if prefix == b"*":
+        return [await read_reply(reader) for _ in range(int(value))]
+
+    raise BackplaneError("unexpected reply: %r" % line)
+
+
+async def open_connection(url, attempts=50, delay=0.1):
+    parts = urlsplit(url)
+
+    for attempt in range(attempts):
+        try:
+            if parts.scheme == "unix":
+                reader, writer = await asyncio.open_unix_connection(parts.path)
+            elif parts.scheme == "redis":
+                reader, writer = await asyncio.open_connection(parts.hostname or "localhost", parts.port or 6379)
+            else:
+                raise BackplaneError("unsupported backplane url: %s" % url)
+            break
+        except (ConnectionRefusedError, FileNotFoundError):
+            if attempt == attempts - 1:
+                raise
+
+            await asyncio.sleep(delay)
+
+    if parts.password:
+        writer.write(encode_command("AUTH", parts.password))
+        await read_reply(reader)
+
+    return reader, writer
+
+
+# speaks the subset of the Redis protocol implemented by BackplaneBroker,
+# so it works against either of them
+class Backplane:
+    # messages handled at once, reading waits for a free slot beyond that
+    MAX_HANDLERS = 64
+
+    def __init__(self, url):
+        self.url = url
+        self.subscriptions = {}
+        self.publisher = None
+        self.subscriber = None
+        self.tasks = []
+        self.handlers = set()
+        self.handler_slots = asyncio.Semaphore(self.MAX_HANDLERS)
+
+        self.published = 0
+        self.received = 0
+
+    async def start(self):
+        publisher_reader, self.publisher = await open_connection(self.url)
+        subscriber_reader, self.subscriber = await open_connection(self.url)
+
+        self.tasks = [
+            asyncio.create_task(self.read_publish_replies(publisher_reader)),
+            asyncio.create_task(self.read_messages(subscriber_reader)),
+        ]
+
+    async def stop(self):
+        for task in [*self.tasks, *self.handlers]:
+            task.cancel()
+
+        for writer in (self.publisher, self.subscriber):
+            if writer:
+                writer.close()
+
+    async def publish(self, channel, data):
+        # replies are consumed by read_publish_replies, publishing only waits while the broker is behind
+        self.publisher.write(encode_command("PUBLISH", channel, data))
+        self.published += 1
+
+        await self.publisher.drain()
+
+    async def subscribe(self, channel, callback):
+        self.subscriptions[channel.encode()] = callback
+        self.subscriber.write(encode_command("SUBSCRIBE", channel))
+        await self.subscriber.drain()
+
+    async def read_publish_replies(self, reader):
+        while True:
+            try:
+                await read_reply(reader)
+            except BackplaneError as e:
+                logger.error("publishing failed: %s", e)
+
+    async def read_messages(self, reader):
+        while True:
+            reply = await read_reply(reader)
+
+            if reply[0] != b"message":
+                continue
+
+            _, channel, data = reply
+            self.received += 1
+
+            # a slow handler must not hold up the messages behind it, handlers start in the order
+            # the messages arrived, subscribers keep the order they need from there
+            await self.handler_slots.acquire()
+            handler = asyncio.create_task(self.handle_message(channel, data))
+            self.handlers.add(handler)
+            handler.add_done_callback(self.handlers.discard)
+
+    async def handle_message(self, channel, data):
+        try:
+            await self.subscriptions[channel](data)
+        except Exception as e:
+            logger.exception("error handling backplane message on %s: %s", channel, e)
+        finally:
+            self.handler_slots.release()
+
+
+class BackplaneBroker:
+    # seconds a subscriber may keep its buffer above the high-water mark before it is disconnected
+    DRAIN_TIMEOUT = 10
+
+    def __init__(self, path):
+        self.path = path
+        self.subscribers = {}
+        self.server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        self.server = await asyncio.start_unix_server(self.handle_client, path=self.path)
+        logger.info("backplane broker listening on %s", self.path)
+
+    async def serve_forever(self):
+        await self.start()
+
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def handle_client(self, reader, writer):
+        channels = set()
+
+        try:
+            while True:
+                command = await read_reply(reader)
+                name = command[0].upper()
+
+                if name == b"PUBLISH":
+                    _, channel, data = command
+                    subscribers = self.subscribers.get(channel, ())
+                    message = encode_command("message", channel, data)
+
+                    writer.write(b":%d\r\n" % len(subscribers))
+
+                    for subscriber in list(subscribers):
+                        subscriber.write(message)
+
+                    for subscriber in list(subscribers):
+                        await self.drain(subscriber)
+                elif name == b"SUBSCRIBE":
+                    for channel in command[1:]:
+                        channels.add(channel)
+                        self.subscribers.setdefault(channel, set()).add(writer)
+                        writer.write(b"*3\r\n" + encode_bulk("subscribe") + encode_bulk(channel) + b":%d\r\n" % len(channels))
+                elif name == b"PING":
+                    writer.write(b"+PONG\r\n")
+                else:
+                    writer.write(b"-ERR unknown command\r\n")
+
+                await writer.drain()
+        except (ConnectionResetError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for channel in channels:
+                self.subscribers[channel].discard(writer)
+
+            writer.close()
+
+    async def drain(self, subscriber):
+        try:
+            await asyncio.wait_for(subscriber.drain(), self.DRAIN_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionResetError) as e:
+            logger.warning("disconnecting backplane subscriber that does not keep up: %r", e)
+
+            for subscribers in self.subscribers.values():
+                subscribers.discard(subscriber)
+
+            subscriber.transport.abort()
@@ -3,18 +3,33 @@ import logging
 
 class ClientNotificationService:
 
-    def __init__(self, service_name = None, on_event = None):
+    def __init__(self, service_name = None, on_event = None, on_broadcast = None):
         self.service_name = service_name
         self.on_event = on_event or self.log_unhandled_event
+        self.on_broadcast = on_broadcast or self.publish_each
 
-    async def log_unhandled_event(self, event_data):
+    async def log_unhandled_event(self, client_id, event_data):
         logging.warning("unhandled event: %s" % str(event_data))
 
-    async def publish(self, client_id, event, *args):
+    async def publish_each(self, client_ids, event_data):
+        for client_id in client_ids:
+            await self.on_event(client_id, event_data)
+
+    def event_data(self, event, args, seq):
         event_data = {
             "service":   self.service_name,
             "name":      str(event),
             "arguments": args
         }
 
-        await self.on_event(client_id, event_data)
+        if seq is not None:
+            event_data["seq"] = seq
+
+        return event_data
+
+    async def publish(self, client_id, event, *args, seq=None):
+        await self.on_event(client_id, self.event_data(event, args, seq))
+
+    async def broadcast(self, client_ids, event, *args, seq=None):
+        if client_ids:
+            await self.on_broadcast(client_ids, self.event_data(event, args, seq))
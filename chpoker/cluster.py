@@ -0,0 +1,294 @@
+import asyncio
+import collections
+import functools
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import zlib
+
+from .backplane import BackplaneBroker
+from .jsonencoder import dumps, encode_object
+
+logger = logging.getLogger(__name__)
+
+# seconds a worker gets to shut down gracefully before it is killed
+WORKER_STOP_TIMEOUT = 10
+
+
+class RemoteError(Exception):
+    pass
+
+
+class WireObject:
+    # a user forwarded by the owning worker, codecs encode it like the original
+    __slots__ = ("wire",)
+
+    def __init__(self, wire):
+        self.wire = wire
+
+    def __iter__(self):
+        return iter(self.wire.items())
+
+
+def encode_backplane_object(o):
+    try:
+        return {"__wire__": o.wire}
+    except AttributeError:
+        pass
+
+    return encode_object(o)
+
+
+def decode_backplane_object(data):
+    if len(data) == 1 and "__wire__" in data:
+        return WireObject(data["__wire__"])
+
+    return data
+
+
+class ClusterRouter:
+    CHANNEL = "chpoker.worker.%d"
+    CALL_TIMEOUT = 10
+
+    def __init__(self, service, methods, protocol, backplane, worker_id, workers):
+        self.service = service
+        self.protocol = protocol
+        self.backplane = backplane
+        self.worker_id = worker_id
+        self.workers = workers
+
+        # clients connected here whose room is owned by another worker
+        self.remote_clients = {}
+        # clients of rooms owned here that are connected to another worker
+        self.client_origins = {}
+        self.pending_calls = {}
+        self.call_ids = itertools.count()
+        # the backplane handles messages concurrently, calls of one client still run in the order sent
+        self.client_locks = {}
+
+        for method_name in methods:
+            setattr(self, method_name, functools.partial(self.dispatch, method_name))
+
+    def owner(self, room_id):
+        room_id = room_id or self.service.DEFAULT_ROOM_ID
+        return zlib.crc32(room_id.encode()) % self.workers
+
+    async def start(self, app=None):
+        await self.backplane.start()
+        await self.backplane.subscribe(self.CHANNEL % self.worker_id, self.on_message)
+
+    async def stop(self, app=None):
+        await self.backplane.stop()
+
+    async def publish(self, worker_id, message):
+        await self.backplane.publish(self.CHANNEL % worker_id, dumps(message, default=encode_backplane_object))
+
+    async def on_connected(self, client_id, session_data):
+        owner = self.owner(session_data.get("room"))
+
+        if owner == self.worker_id:
+            self.remote_clients.pop(client_id, None)
+            self.client_origins.pop(client_id, None)
+            await self.service.on_connected(client_id, session_data)
+        else:
+            self.remote_clients[client_id] = owner
+            await self.call_remote(owner, "on_connected", client_id, session_data)
+
+    async def on_disconnected(self, client_id):
+        if client_id in self.client_origins and client_id not in self.remote_clients:
+            logger.debug("client %s has moved to worker %d, ignoring the old connection", client_id,
+                         self.client_origins[client_id])
+            return
+
+        try:
+            await self.dispatch("on_disconnected", client_id)
+        finally:
+            self.remote_clients.pop(client_id, None)
+
+    async def dispatch(self, method_name, client_id, *args, **kwargs):
+        try:
+            owner = self.remote_clients[client_id]
+        except KeyError:
+            return await getattr(self.service, method_name)(client_id, *args, **kwargs)
+
+        return await self.call_remote(owner, method_name, client_id, *args, **kwargs)
+
+    async def history_page(self, room_id, before=None, limit=20):
+        # rounds not spilled yet are only known to the worker owning the room
+        owner = self.owner(room_id)
+
+        if owner == self.worker_id:
+            return await self.service.history_page(room_id, before, limit)
+
+        return await self.call_remote(owner, "history_page", None, room_id, before, limit)
+
+    async def call_remote(self, worker_id, method_name, client_id, *args, **kwargs):
+        call_id = next(self.call_ids)
+        future = self.pending_calls[call_id] = asyncio.get_running_loop().create_future()
+
+        await self.publish(worker_id, {
+            "op": "call",
+            "origin": self.worker_id,
+            "call_id": call_id,
+            "method": method_name,
+            "client_id": client_id,
+            "args": args,
+            "kwargs": kwargs
+        })
+
+        try:
+            return await asyncio.wait_for(future, self.CALL_TIMEOUT)
+        finally:
+            del self.pending_calls[call_id]
+
+    async def on_message(self, data):
+        message = json.loads(data, object_hook=decode_backplane_object)
+
+        if message["op"] == "call":
+            await self.on_client_call(message)
+        elif message["op"] == "result":
+            self.on_result(message)
+        elif message["op"] == "event":
+            await self.protocol.broadcast_event(message["client_ids"], message["event"])
+        else:
+            logger.warning("unknown backplane message: %s", message)
+
+    async def on_client_call(self, message):
+        client_id = message["client_id"]
+
+        if client_id is None:
+            return await self.on_call(message)
+
+        # [lock, calls holding or waiting for it]
+        entry = self.client_locks.setdefault(client_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+
+        try:
+            async with entry[0]:
+                await self.on_call(message)
+        finally:
+            entry[1] -= 1
+
+            if not entry[1]:
+                del self.client_locks[client_id]
+
+    async def on_call(self, message):
+        client_id = message["client_id"]
+        origin = message["origin"]
+
+        reply = {
+            "op": "result",
+            "call_id": message["call_id"],
+            "result": None,
+            "error": None
+        }
+
+        # calls without a client concern a room of this worker
+        args = message["args"] if client_id is None else [client_id, *message["args"]]
+
+        if client_id is None:
+            pass
+        elif message["method"] == "on_connected":
+            self.client_origins[client_id] = origin
+        elif self.client_origins.get(client_id) != origin:
+            # the client has reconnected elsewhere since, its old connection no longer speaks for it
+            logger.debug("ignoring %s for client %s from worker %d", message["method"], client_id, origin)
+
+            if message["method"] != "on_disconnected":
+                reply["error"] = "RemoteError: client %s is not connected to worker %d" % (client_id, origin)
+
+            await self.publish(origin, reply)
+            return
+
+        try:
+            method = getattr(self.service, message["method"])
+            reply["result"] = await method(*args, **message["kwargs"])
+        except Exception as e:
+            logger.warning("remote call %s from worker %d failed: %r", message["method"], origin, e)
+            reply["error"] = "%s: %s" % (e.__class__.__name__, e)
+
+        if message["method"] == "on_disconnected":
+            self.client_origins.pop(client_id, None)
+
+        await self.publish(origin, reply)
+
+    def on_result(self, message):
+        try:
+            future = self.pending_calls[message["call_id"]]
+        except KeyError:
+            logger.warning("result for unknown call %s", message["call_id"])
+            return
+
+        if message["error"]:
+            future.set_exception(RemoteError(message["error"]))
+        else:
+            future.set_result(message["result"])
+
+    async def send_event(self, client_id, event_data):
+        await self.broadcast_event([client_id], event_data)
+
+    async def broadcast_event(self, client_ids, event_data):
+        local_client_ids = []
+        remote_client_ids = collections.defaultdict(list)
+
+        for client_id in client_ids:
+            try:
+                remote_client_ids[self.client_origins[client_id]].append(client_id)
+            except KeyError:
+                local_client_ids.append(client_id)
+
+        if local_client_ids:
+            await self.protocol.broadcast_event(local_client_ids, event_data)
+
+        for worker_id, worker_client_ids in remote_client_ids.items():
+            await self.publish(worker_id, {
+                "op": "event",
+                "client_ids": worker_client_ids,
+                "event": event_data
+            })
+
+
+def stop_workers(signum, frame):
+    raise SystemExit(0)
+
+
+def run_workers(workers, run_worker, broker_path=None):
+    # workers are not daemonic, daemonic processes may not start the process pool of the acs
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=run_worker, args=(worker_id,)) for worker_id in range(workers)]
+
+    for process in processes:
+        process.start()
+
+    logger.info("started %d workers", workers)
+
+    # the workers have to be stopped here, they do not end with this process any more
+    previous_handler = signal.signal(signal.SIGTERM, stop_workers)
+
+    try:
+        if broker_path:
+            asyncio.run(BackplaneBroker(broker_path).serve_forever())
+        else:
+            for process in processes:
+                process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+
+        for process in processes:
+            process.join(WORKER_STOP_TIMEOUT)
+
+            if process.is_alive():
+                logger.warning("worker %d did not stop in time, killing it", process.pid)
+                process.kill()
+                process.join()
+
+        signal.signal(signal.SIGTERM, previous_handler)
+
+        if broker_path and os.path.exists(broker_path):
+            os.unlink(broker_path)
@@ -1,4 +1,5 @@
 import argparse
+import functools
 import logging
 import tomllib
 import os.path
@@ -13,9 +14,42 @@ class Config:
         2: logging.DEBUG
     }
     SIGNING_KEY_SIZE = 32
+    DEFAULTS = {
+        "send_queue_size": 256,
+        "send_timeout": 10,
+        "overflow_policy": "drop",
+        "max_connections": None,
+        "max_room_connections": None,
+        "max_message_size": 65536,
+        "heartbeat_interval": 30,
+        "handshake_timeout": 10,
+        "rate_limits": {"*": [20, 40], "estimate_target": [5, 10]},
+        "session_grace_period": 600,
+        "identity_cache_size": 4096,
+        "identity_cache_ttl": 300,
+        "accept_legacy_tokens": True,
+        "update_batch_window": False,
+        "event_log_size": 256,
+        "workers": 1,
+        "backplane_url": None,
+        "journal_dir": None,
+        "journal_fsync": "interval",
+        "journal_fsync_interval": 1,
+        "journal_snapshot_interval": 10000,
+        "history_dir": None,
+        "history_memory_rounds": 500,
+        "idp_metadata_refresh_interval": 3600,
+        "idp_metadata_cache_dir": None,
+        "acs_executor": "thread",
+        "acs_workers": 4,
+        "acs_max_pending": 64,
+        "profile": False,
+        "slow_handler_threshold": 100,
+        "admin_token": None,
+    }
 
     def __init__(self):
-        self.config = {}
+        self.config = dict(self.DEFAULTS)
 
         self.load_config()
         self.load_args()
@@ -38,11 +72,21 @@ class Config:
             action="count",
             default=0
         )
+        parser.add_argument(
+            "--profile",
+            action="store_true",
+            default=argparse.SUPPRESS
+        )
         parser.add_argument(
             "--debug-identity",
             action="store_true",
             default=False
         )
+        parser.add_argument(
+            "--workers", "-w",
+            type=int,
+            default=argparse.SUPPRESS
+        )
 
         self.config.update(vars(parser.parse_args()))
 
@@ -66,6 +110,25 @@ class Config:
         return self.verbose > 1
 
     @property
+    def update_batch_delay(self):
+        window = self.config["update_batch_window"]
+
+        if window == "tick":
+            return 0
+
+        if window is False:
+            return None
+
+        return window / 1000
+
+    @property
+    def slow_handler_duration(self):
+        if not self.config["profile"]:
+            return None
+
+        return self.config["slow_handler_threshold"] / 1000
+
+    @functools.cached_property
     def signing_key(self):
         try:
             return self.config["signing_key"].encode()
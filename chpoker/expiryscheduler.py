@@ -0,0 +1,36 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiryScheduler:
+
+    def __init__(self, grace_period, on_expired):
+        self.grace_period = grace_period
+        self.on_expired = on_expired
+        self.timers = {}
+
+    @property
+    def tracked(self):
+        return len(self.timers)
+
+    def schedule(self, key):
+        self.cancel(key)
+
+        loop = asyncio.get_running_loop()
+        self.timers[key] = loop.call_later(self.grace_period, self.expire, key)
+
+    def cancel(self, key):
+        try:
+            self.timers.pop(key).cancel()
+        except KeyError:
+            pass
+
+    def expire(self, key):
+        del self.timers[key]
+
+        try:
+            self.on_expired(key)
+        except Exception as e:
+            logger.exception("error expiring %s: %s", key, e)
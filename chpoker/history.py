@@ -0,0 +1,301 @@
+import json
+import logging
+import math
+import os
+import re
+import statistics
+from array import array
+from hashlib import blake2b
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_NAME = re.compile(r"^(\d+)-(\d+)\.jsonl$")
+
+
+def consensus(scores):
+    if not scores:
+        return math.nan, math.nan, math.nan, []
+
+    mean = statistics.mean(scores)
+    median = statistics.median(scores)
+
+    # Tukey's fences, too few votes have no meaningful quartiles
+    low, high = -math.inf, math.inf
+    if len(scores) >= 3:
+        q1, _, q3 = statistics.quantiles(scores, n=4, method="inclusive")
+        low, high = q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1)
+
+    return mean, median, max(scores) - min(scores), [not low <= score <= high for score in scores]
+
+
+def optional(value):
+    return None if math.isnan(value) else value
+
+
+def vote_score(value):
+    # the score column holds doubles, whole scores go back out as the ints they were voted as
+    return int(value) if value.is_integer() else value
+
+
+class RoomHistory:
+    # columns hold one entry per round, votes of round n are vote_*[vote_offsets[n]:vote_offsets[n + 1]]
+
+    def __init__(self, room_id, directory=None):
+        self.room_id = room_id
+        self.directory = directory
+
+        self.round_ids = array("q")
+        self.started_at = array("d")
+        self.revealed_at = array("d")
+        self.mean = array("d")
+        self.median = array("d")
+        self.spread = array("d")
+        self.vote_offsets = array("L", [0])
+        self.vote_users = array("L")
+        self.vote_scores = array("d")
+        self.vote_outliers = array("B")
+
+        # users are stored once per room, votes refer to them by index
+        self.users = []
+        self.user_indexes = {}
+
+        self.next_round_id = max((last for _, last in self.segments()), default=0) + 1
+
+    def __len__(self):
+        return len(self.round_ids)
+
+    @property
+    def last_round_id(self):
+        return self.round_ids[-1] if self.round_ids else None
+
+    def user_index(self, user_id, name):
+        try:
+            return self.user_indexes[user_id, name]
+        except KeyError:
+            index = self.user_indexes[user_id, name] = len(self.users)
+            self.users.append((user_id, name))
+            return index
+
+    def add(self, started_at, revealed_at, votes):
+        scores = [score for _, _, score in votes]
+        mean, median, spread, outliers = consensus(scores)
+
+        self.round_ids.append(self.next_round_id)
+        self.started_at.append(started_at)
+        self.revealed_at.append(revealed_at)
+        self.mean.append(mean)
+        self.median.append(median)
+        self.spread.append(spread)
+
+        for (user_id, name, score), outlier in zip(votes, outliers):
+            self.vote_users.append(self.user_index(user_id, name))
+            self.vote_scores.append(score)
+            self.vote_outliers.append(outlier)
+
+        self.vote_offsets.append(len(self.vote_scores))
+        self.next_round_id += 1
+
+        return self.round(len(self) - 1)
+
+    def pop(self):
+        self.next_round_id = self.round_ids.pop()
+
+        for column in (self.started_at, self.revealed_at, self.mean, self.median, self.spread):
+            column.pop()
+
+        self.vote_offsets.pop()
+        del self.vote_users[self.vote_offsets[-1]:]
+        del self.vote_scores[self.vote_offsets[-1]:]
+        del self.vote_outliers[self.vote_offsets[-1]:]
+
+    def round(self, n):
+        votes = []
+        outliers = []
+
+        for v in range(self.vote_offsets[n], self.vote_offsets[n + 1]):
+            user_id, name = self.users[self.vote_users[v]]
+            votes.append({"user": user_id, "name": name, "score": vote_score(self.vote_scores[v])})
+
+            if self.vote_outliers[v]:
+                outliers.append(user_id)
+
+        return {
+            "round": self.round_ids[n],
+            "started_at": self.started_at[n],
+            "revealed_at": self.revealed_at[n],
+            "votes": votes,
+            "mean": optional(self.mean[n]),
+            "median": optional(self.median[n]),
+            "spread": optional(self.spread[n]),
+            "outliers": outliers,
+        }
+
+    def drop(self, count):
+        first_vote = self.vote_offsets[count]
+
+        for column in (self.round_ids, self.started_at, self.revealed_at, self.mean, self.median, self.spread):
+            del column[:count]
+
+        self.vote_offsets = array("L", (offset - first_vote for offset in self.vote_offsets[count:]))
+        del self.vote_scores[:first_vote]
+        del self.vote_outliers[:first_vote]
+
+        # forget users that only voted in the dropped rounds
+        users = self.users
+        vote_users = self.vote_users[first_vote:]
+        self.users = []
+        self.user_indexes = {}
+        self.vote_users = array("L", (self.user_index(*users[index]) for index in vote_users))
+
+    @property
+    def path(self):
+        # room ids come from clients, hashing them keeps names like ".." inside the directory
+        return os.path.join(self.directory, blake2b(self.room_id.encode(), digest_size=16).hexdigest())
+
+    def segments(self):
+        if not self.directory:
+            return []
+
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+
+        return sorted((int(match[1]), int(match[2])) for match in map(SEGMENT_NAME.match, names) if match)
+
+    def segment_path(self, first, last):
+        return os.path.join(self.path, "%010d-%010d.jsonl" % (first, last))
+
+    def spill(self, count):
+        # segments are written once and never modified, rounds in memory follow the last one
+        if self.directory and count:
+            os.makedirs(self.path, exist_ok=True)
+            path = self.segment_path(self.round_ids[0], self.round_ids[count - 1])
+
+            with open(path + ".tmp", "w") as f:
+                for n in range(count):
+                    f.write(json.dumps(self.round(n), separators=(",", ":")) + "\n")
+
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(path + ".tmp", path)
+            logger.debug("wrote %d rounds of room %s to %s", count, self.room_id, path)
+
+        self.drop(count)
+
+    def read_segment(self, first, last):
+        with open(self.segment_path(first, last)) as f:
+            return [json.loads(line) for line in f]
+
+    def page(self, before=None, limit=20):
+        # newest rounds first, "next" is the cursor for the following page
+        rounds = []
+
+        for n in reversed(range(len(self))):
+            if len(rounds) == limit:
+                break
+
+            if before is None or self.round_ids[n] < before:
+                rounds.append(self.round(n))
+
+        for first, last in reversed(self.segments()):
+            if len(rounds) == limit:
+                break
+
+            if (before is not None and first >= before) or (self.round_ids and last >= self.round_ids[0]):
+                continue
+
+            for entry in reversed(self.read_segment(first, last)):
+                if len(rounds) == limit:
+                    break
+
+                if before is None or entry["round"] < before:
+                    rounds.append(entry)
+
+        has_more = rounds and rounds[-1]["round"] > self.first_round_id
+
+        return {
+            "room": self.room_id,
+            "rounds": rounds,
+            "next": rounds[-1]["round"] if has_more else None,
+        }
+
+    @property
+    def first_round_id(self):
+        segments = self.segments()
+
+        if segments:
+            return segments[0][0]
+
+        return self.round_ids[0] if self.round_ids else None
+
+
+class VoteHistory:
+    MAX_PAGE_SIZE = 100
+
+    def __init__(self, directory=None, memory_rounds=500):
+        self.directory = directory
+        self.memory_rounds = memory_rounds
+        self.rooms = {}
+
+        self.rounds = 0
+        self.spilled_rounds = 0
+
+    @property
+    def stats(self):
+        return {
+            "rooms": len(self.rooms),
+            "rounds_in_memory": sum(len(history) for history in self.rooms.values()),
+            "rounds": self.rounds,
+            "spilled_rounds": self.spilled_rounds,
+        }
+
+    def get(self, room_id):
+        try:
+            return self.rooms[room_id]
+        except KeyError:
+            history = self.rooms[room_id] = RoomHistory(room_id, self.directory)
+            return history
+
+    def add_round(self, room_id, started_at, revealed_at, votes, replace_round=None):
+        history = self.get(room_id)
+
+        # revealing the same target again replaces its round
+        if replace_round is not None and history.last_round_id == replace_round:
+            history.pop()
+        else:
+            self.rounds += 1
+
+        entry = history.add(started_at, revealed_at, votes)
+
+        if len(history) > self.memory_rounds:
+            count = len(history) - self.memory_rounds // 2
+            history.spill(count)
+            self.spilled_rounds += count
+
+        return entry
+
+    def page(self, room_id, before=None, limit=20):
+        limit = max(1, min(limit, self.MAX_PAGE_SIZE))
+
+        try:
+            history = self.rooms[room_id]
+        except KeyError:
+            # rooms that are not open here may still have segments on disk
+            history = RoomHistory(room_id, self.directory)
+
+        return history.page(before, limit)
+
+    def close_room(self, room_id):
+        try:
+            history = self.rooms.pop(room_id)
+        except KeyError:
+            return
+
+        self.spilled_rounds += len(history) if self.directory else 0
+        history.spill(len(history))
+
+    def close(self):
+        for room_id in list(self.rooms):
+            self.close_room(room_id)
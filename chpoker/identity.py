@@ -1,7 +1,10 @@
 import base64
+import collections
 import itertools
 import json
 import pickle
+import struct
+from datetime import datetime, timedelta
 from hashlib import blake2b
 from hmac import compare_digest
 
@@ -16,6 +19,54 @@ class InvalidSignature(Exception):
     pass
 
 
+class IdentityCache:
+
+    def __init__(self, max_size=4096, ttl=300):
+        self.max_size = max_size
+        self.ttl = timedelta(seconds=ttl)
+        self.entries = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def get(self, token):
+        try:
+            identity, expires_at = self.entries[token]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        if expires_at <= datetime.now():
+            del self.entries[token]
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(token)
+        self.hits += 1
+        return identity
+
+    def put(self, token, identity):
+        if self.max_size <= 0:
+            return
+
+        self.entries[token] = identity, min(datetime.now() + self.ttl, identity.expiration)
+        self.entries.move_to_end(token)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+
 class BaseIdentitySigner:
     def sign_identity(self, identity: Identity):
         raise NotImplementedError()
@@ -27,14 +78,25 @@ class BaseIdentitySigner:
 class IdentitySigner(BaseIdentitySigner):
     KEY_SIZE = 32
     AUTH_SIZE = 32
-
-    def __init__(self, secret_key):
+    TOKEN_VERSION = 2
+    # version, flags, expiration timestamp
+    TOKEN_HEADER = struct.Struct("!BBq")
+    TOKEN_STRING_LENGTH = struct.Struct("!H")
+    FLAG_CAN_MODERATE = 0x01
+    FLAG_DISPLAY_NAME = 0x02
+
+    def __init__(self, secret_key, cache_size=4096, cache_ttl=300, accept_legacy_tokens=True):
         self.secret_key = secret_key
+        self.cache = IdentityCache(max_size=cache_size, ttl=cache_ttl)
+        self.accept_legacy_tokens = accept_legacy_tokens
 
-    def sign(self, payload):
+    def digest(self, payload):
         h = blake2b(digest_size=self.AUTH_SIZE, key=self.secret_key)
         h.update(payload)
-        return h.hexdigest()
+        return h.digest()
+
+    def sign(self, payload):
+        return self.digest(payload).hex()
 
     def verify(self, payload, sig):
         good_sig = self.sign(payload)
@@ -59,16 +121,83 @@ class IdentitySigner(BaseIdentitySigner):
 
         return pickle.loads(base64.b64decode(encoded_payload))
 
+    def encode_token(self, identity: Identity):
+        flags = 0
+        strings = [identity.id, identity.first_name, identity.last_name]
+
+        if identity.can_moderate:
+            flags |= self.FLAG_CAN_MODERATE
+
+        if identity.display_name is not None:
+            flags |= self.FLAG_DISPLAY_NAME
+            strings.append(identity.display_name)
+
+        payload = bytearray(self.TOKEN_HEADER.pack(self.TOKEN_VERSION, flags, int(identity.expiration.timestamp())))
+
+        for string in strings:
+            encoded_string = string.encode()
+            payload += self.TOKEN_STRING_LENGTH.pack(len(encoded_string))
+            payload += encoded_string
+
+        payload += self.digest(payload)
+        return base64.urlsafe_b64encode(payload).rstrip(b"=").decode("ascii")
+
+    def decode_token(self, token):
+        try:
+            payload = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        except ValueError:
+            raise InvalidPayload()
+
+        payload, signature = payload[:-self.AUTH_SIZE], payload[-self.AUTH_SIZE:]
+
+        if not compare_digest(self.digest(payload), signature):
+            raise InvalidSignature()
+
+        try:
+            version, flags, expiration = self.TOKEN_HEADER.unpack_from(payload)
+            if version != self.TOKEN_VERSION:
+                raise InvalidPayload()
+
+            offset = self.TOKEN_HEADER.size
+            strings = []
+
+            while offset < len(payload):
+                length, = self.TOKEN_STRING_LENGTH.unpack_from(payload, offset)
+                offset += self.TOKEN_STRING_LENGTH.size
+                strings.append(payload[offset:offset + length].decode())
+                offset += length
+        except (struct.error, UnicodeDecodeError):
+            raise InvalidPayload()
+
+        if len(strings) != (4 if flags & self.FLAG_DISPLAY_NAME else 3):
+            raise InvalidPayload()
+
+        return Identity(
+            *strings,
+            can_moderate=bool(flags & self.FLAG_CAN_MODERATE),
+            expiration=datetime.fromtimestamp(expiration)
+        )
+
     def sign_identity(self, identity: Identity):
-        return self.sign_object(identity.__dict__)
+        return self.encode_token(identity)
 
     def unsign_identity(self, signed_identity: str):
         assert signed_identity, "invalid identity string"
 
-        identity_data = self.unsign_object(signed_identity)
-        identity = Identity(**identity_data)
+        identity = self.cache.get(signed_identity)
+        if identity:
+            return identity
+
+        if ":" not in signed_identity:
+            identity = self.decode_token(signed_identity)
+        elif self.accept_legacy_tokens:
+            identity = Identity(**self.unsign_object(signed_identity))
+        else:
+            raise InvalidPayload()
+
         assert identity.valid, "invalid identity"
 
+        self.cache.put(signed_identity, identity)
         return identity
 
 
@@ -0,0 +1,171 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from dataclasses import asdict
+from datetime import datetime
+from enum import StrEnum, auto, unique
+
+from .jsonencoder import JSONEncoder
+from .models.identity import Identity, DebugIdentity
+
+logger = logging.getLogger(__name__)
+
+
+@unique
+class FsyncPolicy(StrEnum):
+    ALWAYS = auto()
+    INTERVAL = auto()
+    NEVER = auto()
+
+
+def dump_identity(identity):
+    data = asdict(identity)
+
+    if "expiration" in data:
+        data["expiration"] = data["expiration"].isoformat()
+
+    return data
+
+
+def load_identity(data):
+    if "expiration" not in data:
+        return DebugIdentity(**data)
+
+    return Identity(**{**data, "expiration": datetime.fromisoformat(data["expiration"])})
+
+
+class NullJournal:
+    snapshot_due = False
+
+    def append(self, record):
+        pass
+
+    def load(self):
+        return None, []
+
+    def write_snapshot(self, state):
+        pass
+
+    def close(self):
+        pass
+
+
+class Journal:
+    JOURNAL_FILE = "journal.jsonl"
+    SNAPSHOT_FILE = "snapshot.json"
+
+    def __init__(self, path, fsync=FsyncPolicy.INTERVAL, fsync_interval=1, snapshot_interval=10000):
+        self.path = path
+        self.fsync = FsyncPolicy(fsync)
+        self.fsync_interval = fsync_interval
+        self.snapshot_interval = snapshot_interval
+        self.file = None
+        self.sync_timer = None
+        self.records_since_snapshot = 0
+
+        self.records = 0
+        self.fsyncs = 0
+        self.snapshots = 0
+
+        os.makedirs(path, exist_ok=True)
+
+    @property
+    def journal_path(self):
+        return os.path.join(self.path, self.JOURNAL_FILE)
+
+    @property
+    def snapshot_path(self):
+        return os.path.join(self.path, self.SNAPSHOT_FILE)
+
+    @property
+    def snapshot_due(self):
+        return self.records_since_snapshot >= self.snapshot_interval
+
+    @property
+    def stats(self):
+        return {
+            "records": self.records,
+            "records_since_snapshot": self.records_since_snapshot,
+            "fsyncs": self.fsyncs,
+            "snapshots": self.snapshots,
+        }
+
+    def load(self):
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            snapshot = None
+
+        records = []
+
+        try:
+            with open(self.journal_path) as f:
+                for line_number, line in enumerate(f, 1):
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # a torn write at the end of the journal, everything after it is lost anyway
+                        logger.warning("journal %s is truncated at line %d", self.journal_path, line_number)
+                        break
+        except FileNotFoundError:
+            pass
+
+        self.records_since_snapshot = len(records)
+        return snapshot, records
+
+    def open(self):
+        if not self.file:
+            self.file = open(self.journal_path, "a")
+
+        return self.file
+
+    def append(self, record):
+        f = self.open()
+        f.write(json.dumps(record, cls=JSONEncoder, separators=(",", ":")) + "\n")
+        f.flush()
+
+        self.records += 1
+        self.records_since_snapshot += 1
+
+        if self.fsync == FsyncPolicy.ALWAYS:
+            self.sync()
+        elif self.fsync == FsyncPolicy.INTERVAL and not self.sync_timer:
+            self.sync_timer = asyncio.get_running_loop().call_later(self.fsync_interval, self.sync)
+
+    def sync(self):
+        if self.sync_timer:
+            self.sync_timer.cancel()
+            self.sync_timer = None
+
+        if self.file:
+            os.fsync(self.file.fileno())
+            self.fsyncs += 1
+
+    def write_snapshot(self, state):
+        started = time.perf_counter()
+        temp_path = self.snapshot_path + ".tmp"
+
+        with open(temp_path, "w") as f:
+            json.dump(state, f, cls=JSONEncoder, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(temp_path, self.snapshot_path)
+
+        # records written before the snapshot are replayed on top of it if the
+        # journal could not be truncated, which is harmless as replay is idempotent
+        self.close()
+        self.file = open(self.journal_path, "w")
+        self.records_since_snapshot = 0
+        self.snapshots += 1
+
+        logger.info("wrote snapshot of %s in %.3fs", self.path, time.perf_counter() - started)
+
+    def close(self):
+        if self.file:
+            self.sync()
+            self.file.close()
+            self.file = None
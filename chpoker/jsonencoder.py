@@ -1,5 +1,25 @@
 import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def encode_object(o):
+    # users keep their encodable form cached, other models iterate over (field, value) pairs
+    try:
+        return o.wire
+    except AttributeError:
+        pass
+
+    try:
+        return dict(o)
+    except TypeError:
+        pass
+
+    raise TypeError("not supported")
+
 
 class JSONEncoder(json.JSONEncoder):
 
@@ -9,9 +29,15 @@ class JSONEncoder(json.JSONEncoder):
         except TypeError:
             pass
 
-        try:
-            return dict(o)
-        except TypeError:
-            pass
+        return encode_object(o)
+
+
+def dumps_json(obj, default=encode_object):
+    return json.dumps(obj, cls = JSONEncoder, default=default)
+
+
+def dumps_orjson(obj, default=encode_object):
+    return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS).decode()
+
 
-        raise TypeError("not supported")
+dumps = dumps_orjson if orjson else dumps_json
@@ -0,0 +1,83 @@
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from . import jsonencoder
+
+
+class JSONCodec:
+    subprotocol = None
+
+    def __init__(self, dumps=None):
+        self.dumps = dumps or jsonencoder.dumps
+
+    def encode(self, message):
+        return self.dumps(message)
+
+    def decode(self, data):
+        return json.loads(data)
+
+    def encode_event(self, event_data):
+        return self.encode({
+            "type": "event",
+            "event": event_data })
+
+    def hello(self):
+        return {}
+
+
+class MsgpackCodec:
+    subprotocol = "chpoker.msgpack"
+    EVENT = 0
+
+    def __init__(self, service_events):
+        self.service_codes = {}
+        self.event_codes = {}
+
+        for service_code, (service_name, events) in enumerate(service_events.items()):
+            self.service_codes[service_name] = service_code
+            self.event_codes[service_name] = {str(event): event_code for event_code, event in enumerate(events)}
+
+    @staticmethod
+    def encode_object(o):
+        # models iterate over (field, value) pairs, send them as positional arrays
+        try:
+            return list(o.wire.values())
+        except AttributeError:
+            pass
+
+        try:
+            return [value for _, value in o]
+        except (TypeError, ValueError):
+            pass
+
+        raise TypeError("not supported")
+
+    def encode(self, message):
+        return msgpack.packb(message, default=self.encode_object)
+
+    def decode(self, data):
+        return msgpack.unpackb(data)
+
+    def encode_event(self, event_data):
+        service_name = event_data["service"]
+        message = [
+            self.EVENT,
+            self.service_codes[service_name],
+            self.event_codes[service_name][event_data["name"]],
+            event_data["arguments"]
+        ]
+
+        if "seq" in event_data:
+            message.append(event_data["seq"])
+
+        return self.encode(message)
+
+    def hello(self):
+        return {
+            "services": self.service_codes,
+            "events": self.event_codes
+        }
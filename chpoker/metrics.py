@@ -0,0 +1,180 @@
+import asyncio
+import bisect
+import logging
+import time
+
+import aiohttp.web
+
+logger = logging.getLogger(__name__)
+
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                             for name, value in zip(names, values))
+
+
+def format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self, const_names, const_values):
+        for label_values, value in self.values.items():
+            yield self.name, format_labels(const_names + self.label_names, const_values + label_values), value
+
+
+class HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.children = {}
+
+    def labels(self, *label_values):
+        try:
+            return self.children[label_values]
+        except KeyError:
+            child = self.children[label_values] = HistogramChild(self.buckets)
+            return child
+
+    def observe(self, value, *label_values):
+        self.labels(*label_values).observe(value)
+
+    def samples(self, const_names, const_values):
+        names = const_names + self.label_names + ("le",)
+
+        for label_values, child in self.children.items():
+            values = const_values + label_values
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                yield self.name + "_bucket", format_labels(names, values + ("+Inf" if bound == float("inf") else bound,)), cumulative
+
+            yield self.name + "_sum", format_labels(names[:-1], values), child.sum
+            yield self.name + "_count", format_labels(names[:-1], values), child.count
+
+
+class Gauge:
+    type = "gauge"
+
+    def __init__(self, name, help, callback, type=None):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.type = type or self.type
+
+    def samples(self, const_names, const_values):
+        yield self.name, format_labels(const_names, const_values), self.callback()
+
+
+class Metrics:
+    NAMESPACE = "chpoker"
+    LOOP_LAG_INTERVAL = 0.5
+
+    def __init__(self, const_labels=None):
+        self.const_labels = const_labels or {}
+        self.metrics = {}
+        self.lag_monitor = None
+
+        self.loop_lag = self.histogram("event_loop_lag_seconds", "event loop scheduling delay")
+        self.last_loop_lag = 0
+        self.gauge("event_loop_last_lag_seconds", "last measured event loop scheduling delay", lambda: self.last_loop_lag)
+
+    def add(self, metric):
+        metric.name = "%s_%s" % (self.NAMESPACE, metric.name)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, callback, type=None):
+        return self.add(Gauge(name, help, callback, type))
+
+    def add_stats(self, prefix, get_stats, counters=()):
+        # exposes the numbers of a "stats" property, keys in counters only ever grow
+        for key, value in get_stats().items():
+            if isinstance(value, (int, float)):
+                self.gauge(
+                    "%s_%s" % (prefix, key),
+                    "%s %s" % (prefix.replace("_", " "), key.replace("_", " ")),
+                    lambda key=key: get_stats()[key],
+                    "counter" if key in counters else None
+                )
+
+    def render(self):
+        const_names = tuple(self.const_labels)
+        const_values = tuple(self.const_labels.values())
+        lines = []
+
+        for metric in self.metrics.values():
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+
+            for name, labels, value in metric.samples(const_names, const_values):
+                lines.append("%s%s %s" % (name, labels, format_value(value)))
+
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, request):
+        return aiohttp.web.Response(text=self.render(), headers={
+            "Content-Type": "text/plain; version=0.0.4; charset=utf-8",
+            "Cache-Control": "no-store"
+        })
+
+    async def start(self, app=None):
+        self.lag_monitor = asyncio.create_task(self.monitor_loop_lag())
+
+    async def stop(self, app=None):
+        if self.lag_monitor:
+            self.lag_monitor.cancel()
+
+    async def monitor_loop_lag(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.LOOP_LAG_INTERVAL)
+
+            self.last_loop_lag = max(time.perf_counter() - started - self.LOOP_LAG_INTERVAL, 0)
+            self.loop_lag.observe(self.last_loop_lag)
@@ -0,0 +1,123 @@
+import collections
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, NamedTuple
+
+from .user import Session, SessionType, User
+
+
+class RoomEvent(NamedTuple):
+    seq: int
+    session_type: SessionType
+    user: User
+    event: str
+    args: tuple
+
+
+@dataclass
+class Room:
+    id: str
+    users_by_remote_id: dict[str, User] = field(default_factory=dict)
+    sessions_by_id: dict[str, Session] = field(default_factory=dict)
+    # the same sessions by their type, so notifying hosts does not go through every voter
+    sessions_by_type: dict[SessionType, dict[str, Session]] = field(
+        default_factory=lambda: {session_type: {} for session_type in (SessionType.NONE, SessionType.HOST, SessionType.VOTER)})
+    voters_by_id: dict[str, User] = field(default_factory=dict)
+    pending_scores: int = 0
+    scores_revealed: bool = False
+    pending_updates: dict[str, User] = field(default_factory=dict)
+    updates_flush: Any = None
+    seq: int = 0
+    event_log: collections.deque = field(default_factory=lambda: collections.deque(maxlen=256))
+    target_started_at: float = field(default_factory=time.time)
+    history_round: Any = None
+
+    @property
+    def users(self):
+        return self.users_by_remote_id.values()
+
+    @property
+    def voters(self):
+        return self.voters_by_id.values()
+
+    @property
+    def empty(self):
+        return not self.sessions_by_id
+
+    def find_user_by_remote_id(self, remote_id):
+        try:
+            return self.users_by_remote_id[remote_id]
+        except KeyError:
+            raise ValueError()
+
+    def sessions_of_type(self, session_type):
+        for member, sessions in self.sessions_by_type.items():
+            if member & session_type:
+                yield from sessions.values()
+
+    def get_scores(self):
+        return [user.score for user in self.voters]
+
+    def log_event(self, session_type, user, event, args):
+        self.seq += 1
+        self.event_log.append(RoomEvent(self.seq, session_type, user, event, args))
+        return self.seq
+
+    def events_since(self, seq):
+        if seq == self.seq:
+            return []
+
+        if seq > self.seq or not self.event_log or self.event_log[0].seq > seq + 1:
+            return None
+
+        return [room_event for room_event in self.event_log if room_event.seq > seq]
+
+    @contextmanager
+    def tracking(self, user):
+        was_voting = user.voting
+        was_pending = was_voting and not user.score
+
+        yield
+
+        if user.voting != was_voting:
+            if user.voting:
+                self.voters_by_id[user.id] = user
+            else:
+                del self.voters_by_id[user.id]
+
+        self.pending_scores += (user.voting and not user.score) - was_pending
+
+    def add_user(self, user):
+        self.users_by_remote_id[user.remote_id] = user
+
+    def remove_user(self, user):
+        del self.users_by_remote_id[user.remote_id]
+
+    def add_session(self, session):
+        with self.tracking(session.user):
+            session.user.add_session(session)
+
+        self.sessions_by_id[session.id] = session
+        self.sessions_by_type[session.session_type][session.id] = session
+
+    def remove_session(self, session):
+        with self.tracking(session.user):
+            session.user.remove_session(session)
+
+        del self.sessions_by_id[session.id]
+        del self.sessions_by_type[session.session_type][session.id]
+
+    def set_session_type(self, session, session_type):
+        del self.sessions_by_type[session.session_type][session.id]
+
+        with self.tracking(session.user):
+            session.session_type = session_type
+
+        self.sessions_by_type[session_type][session.id] = session
+
+    def reset_scores(self):
+        for user in self.users:
+            user.score = 0
+
+        self.pending_scores = len(self.voters_by_id)
@@ -1,6 +1,5 @@
 import uuid
-from dataclasses import dataclass, field
-from datetime import datetime, timedelta
+from datetime import datetime
 from enum import Flag, auto
 
 from .identity import Identity
@@ -13,34 +12,100 @@ class SessionType(Flag):
     ANY = NONE | HOST | VOTER
 
 
-@dataclass
 class Session:
-    id: str = field(default_factory=lambda: str(uuid.uuid1()))
-    session_type: SessionType = SessionType.NONE
-    user: "User" = None
-    connected: bool = True
-    last_seen: datetime = field(default_factory=datetime.now)
+    __slots__ = ("id", "user", "last_seen", "_session_type", "_connected")
+
+    def __init__(self, id=None, session_type=SessionType.NONE, user=None, connected=True, last_seen=None):
+        self.id = id or str(uuid.uuid1())
+        self.user = user
+        self.last_seen = last_seen or datetime.now()
+        self._session_type = session_type
+        self._connected = connected
+
+    def __repr__(self):
+        return "Session(id=%r, session_type=%s, connected=%r)" % (self.id, self._session_type, self._connected)
+
+    @property
+    def attached(self):
+        return self.user is not None and self.user.sessions_by_id.get(self.id) is self
+
+    @property
+    def session_type(self):
+        return self._session_type
+
+    @session_type.setter
+    def session_type(self, value):
+        attached = self.attached
+
+        if attached:
+            self.user.count_session(self, -1)
+
+        self._session_type = value
+
+        if attached:
+            self.user.count_session(self, 1)
+
+    @property
+    def connected(self):
+        return self._connected
+
+    @connected.setter
+    def connected(self, value):
+        if value == self._connected:
+            return
+
+        self._connected = value
+
+        if self.attached:
+            self.user.connected_sessions_count += 1 if value else -1
+            self.user.invalidate()
 
     @property
     def host(self):
-        return self.session_type & SessionType.HOST
+        return self._session_type & SessionType.HOST
 
     @property
     def voter(self):
-        return self.session_type & SessionType.VOTER
+        return self._session_type & SessionType.VOTER
+
+
+class User:
+    __slots__ = ("id", "_score", "sessions_by_id", "voter_sessions_count", "host_sessions_count", "connected_sessions_count",
+                 "_wire")
+    WIRE_FIELDS = ("id", "name", "score", "can_host", "active", "connected")
+
+    def __init__(self, id=None, score=0):
+        self.id = id or str(uuid.uuid1())
+        self._score = score
+        self.sessions_by_id = {}
+        self.voter_sessions_count = 0
+        self.host_sessions_count = 0
+        self.connected_sessions_count = 0
+        self._wire = None
+
+    def __repr__(self):
+        return "%s(id=%r, score=%r, sessions=%d)" % (self.__class__.__name__, self.id, self.score, len(self.sessions_by_id))
 
     @property
-    def active(self):
-        return self.connected or (
-            datetime.now() - self.last_seen < timedelta(minutes=10)
-        )
+    def score(self):
+        return self._score
 
+    @score.setter
+    def score(self, value):
+        if value != self._score:
+            self._score = value
+            self._wire = None
 
-@dataclass
-class User:
-    id: str = field(default_factory=lambda: str(uuid.uuid1()))
-    score: int = 0
-    sessions: list[Session] = field(default_factory=list)
+    @property
+    def wire(self):
+        # the fields sent to clients, kept until the score or a session changes
+        if self._wire is None:
+            self._wire = {k: getattr(self, k) for k in self.WIRE_FIELDS}
+
+        return self._wire
+
+    def invalidate(self):
+        self._wire = None
 
     @property
     def remote_id(self):
@@ -54,6 +119,10 @@ class User:
     def can_host(self):
         raise NotImplementedError()
 
+    @property
+    def sessions(self):
+        return self.sessions_by_id.values()
+
     @property
     def voter_sessions(self):
         return [session for session in self.sessions if session.voter]
@@ -64,28 +133,51 @@ class User:
 
     @property
     def voting(self):
-        return len(self.voter_sessions) > 0
+        return self.voter_sessions_count > 0
 
     @property
     def hosting(self):
-        return len(self.host_sessions) > 0
+        return self.host_sessions_count > 0
 
     @property
     def active(self):
-        return any([session.active for session in self.sessions])
+        return len(self.sessions_by_id) > 0
 
     @property
     def connected(self):
-        return any([session.connected for session in self.sessions])
+        return self.connected_sessions_count > 0
+
+    def count_session(self, session, delta):
+        if session.voter:
+            self.voter_sessions_count += delta
+
+        if session.host:
+            self.host_sessions_count += delta
+
+        if session.connected:
+            self.connected_sessions_count += delta
+
+        self._wire = None
+
+    def add_session(self, session):
+        session.user = self
+        self.sessions_by_id[session.id] = session
+        self.count_session(session, 1)
+
+    def remove_session(self, session):
+        del self.sessions_by_id[session.id]
+        self.count_session(session, -1)
 
     def __iter__(self):
-        for k in ("id", "name", "score", "can_host", "active", "connected"):
-            yield k, getattr(self, k)
+        return iter(self.wire.items())
 
 
-@dataclass
 class IdentityUser(User):
-    identity: Identity = None
+    __slots__ = ("identity",)
+
+    def __init__(self, identity: Identity = None, **kwargs):
+        super().__init__(**kwargs)
+        self.identity = identity
 
     @property
     def remote_id(self):
@@ -1,9 +1,18 @@
 from datetime import datetime
 from enum import StrEnum, auto, unique
 
+import asyncio
+import collections
 import logging
-import statistics
-
+import time
+
+from .expiryscheduler import ExpiryScheduler
+from .history import VoteHistory
+from .identity import InvalidPayload, InvalidSignature
+from .journal import NullJournal, dump_identity, load_identity
+from .metrics import Metrics, SIZE_BUCKETS
+from .profiling import count_fanout
+from .models.room import Room
 from .models.user import Session, SessionType, IdentityUser
 
 logger = logging.getLogger(__name__)
@@ -29,125 +38,336 @@ class PokerService:
         LOGGED_IN_HOST = auto()
         LOGGED_OUT_USER = auto()
         UPDATED_USER = auto()
+        USERS_UPDATED = auto()
         PROFILE_UPDATED = auto()
         JOINED_MEETING = auto()
         LEFT_MEETING = auto()
         NEW_TARGET = auto()
         SCORES_REVEALED = auto()
+        ROOM_SNAPSHOT = auto()
         NO_IDENTITY_FOUND = auto()
         LOG_MESSAGE_SENT = auto()
+        HISTORY_PAGE = auto()
+
+    DEFAULT_ROOM_ID = "default"
 
-    def __init__(self, notification_service, identity_signer):
+    def __init__(self, notification_service, identity_signer, session_grace_period=600, update_batch_delay=None,
+                 event_log_size=256, journal=None, metrics=None, history=None):
         self.notification_service = notification_service
         self.identity_signer = identity_signer
-        self.sessions_by_id = {}
-        self.users = []
-        self.scores_revealed = False
+        self.update_batch_delay = update_batch_delay
+        self.event_log_size = event_log_size
+        self.journal = journal or NullJournal()
+        self.history = history or VoteHistory()
+        self.rooms_by_id = {}
+        self.rooms_by_session_id = {}
+        self.session_expiry = ExpiryScheduler(session_grace_period, self.expire_session)
+
+        metrics = metrics or Metrics()
+        self.notify_duration = metrics.histogram("notify_duration_seconds", "time spent sending room events", labels=("event",))
+        self.notify_fanout = metrics.histogram("notify_fanout_sessions", "sessions a room event is sent to", labels=("event",),
+                                               buckets=SIZE_BUCKETS)
+
+    @property
+    def stats(self):
+        return {
+            "rooms": len(self.rooms_by_id),
+            "users": sum(len(room.users_by_remote_id) for room in self.rooms_by_id.values()),
+            "sessions": len(self.rooms_by_session_id),
+            "expiring_sessions": self.session_expiry.tracked,
+        }
+
+    def get_room(self, room_id):
+        try:
+            return self.rooms_by_id[room_id]
+        except KeyError:
+            pass
+
+        logger.info("opening room: %s", room_id)
+        room = self.rooms_by_id[room_id] = Room(
+            id=room_id,
+            event_log=collections.deque(maxlen=self.event_log_size)
+        )
+        return room
+
+    def get_session(self, session_id):
+        room = self.rooms_by_session_id[session_id]
+        return room, room.sessions_by_id[session_id]
+
+    async def start(self, app=None):
+        snapshot, records = self.journal.load()
+
+        if snapshot:
+            for room_state in snapshot["rooms"]:
+                self.restore_room(room_state)
+
+        for record in records:
+            try:
+                self.replay(record)
+            except KeyError as e:
+                logger.debug("skipping journal record %s: %r", record, e)
+
+        # nobody is connected after a restart, clients get the grace period to come back
+        for session_id in self.rooms_by_session_id:
+            self.session_expiry.schedule(session_id)
+
+        if snapshot or records:
+            logger.info("restored %d rooms with %d sessions from a snapshot and %d journal records",
+                        len(self.rooms_by_id), len(self.rooms_by_session_id), len(records))
+
+    async def stop(self, app=None):
+        self.journal.close()
+        self.history.close()
+
+    def dump_state(self):
+        return {
+            "rooms": [{
+                "id": room.id,
+                "scores_revealed": room.scores_revealed,
+                "users": [{
+                    "identity": dump_identity(user.identity),
+                    "score": user.score,
+                    "sessions": [{"id": session.id, "session_type": session.session_type.value} for session in user.sessions]
+                } for user in room.users]
+            } for room in self.rooms_by_id.values()]
+        }
+
+    def restore_room(self, room_state):
+        room = self.get_room(room_state["id"])
+        room.scores_revealed = room_state["scores_revealed"]
+
+        for user_state in room_state["users"]:
+            identity = load_identity(user_state["identity"])
+
+            for session_state in user_state["sessions"]:
+                session = self.add_session(room, session_state["id"], identity, connected=False)
+                room.set_session_type(session, SessionType(session_state["session_type"]))
+
+            user = room.find_user_by_remote_id(identity.id)
+            with room.tracking(user):
+                user.score = user_state["score"]
+
+    def replay(self, record):
+        op = record["op"]
+
+        if op == "session":
+            room = self.get_room(record["room"])
+            if record["session"] not in room.sessions_by_id:
+                self.add_session(room, record["session"], load_identity(record["identity"]), connected=False)
+        elif op == "session_type":
+            room, session = self.get_session(record["session"])
+            room.set_session_type(session, SessionType(record["session_type"]))
+        elif op == "score":
+            room, session = self.get_session(record["session"])
+            with room.tracking(session.user):
+                session.user.score = record["score"]
+        elif op == "new_target":
+            room = self.rooms_by_id[record["room"]]
+            room.scores_revealed = False
+            room.reset_scores()
+        elif op == "reveal":
+            self.rooms_by_id[record["room"]].scores_revealed = True
+        elif op == "expire":
+            self.remove_session(record["session"])
+        else:
+            logger.warning("unknown journal record: %s", record)
+
+    def record(self, op, **data):
+        self.journal.append({"op": op, **data})
+
+        if self.journal.snapshot_due:
+            self.journal.write_snapshot(self.dump_state())
+
+    def add_session(self, room, session_id, identity, **kwargs):
+        try:
+            user = room.find_user_by_remote_id(identity.id)
+        except ValueError:
+            user = IdentityUser(identity=identity)
+            room.add_user(user)
+
+        session = Session(id=session_id, user=user, **kwargs)
+        room.add_session(session)
+        self.rooms_by_session_id[session.id] = room
 
-    def find_user_by_remote_id(self, remote_id):
-        for user in self.users:
-            if user.remote_id == remote_id:
-                return user
+        return session
 
-        raise ValueError()
+    def set_session_type(self, room, session, session_type):
+        room.set_session_type(session, session_type)
+        self.record("session_type", session=session.id, session_type=session_type.value)
 
-    def get_scores(self):
-        return [user.score for user in self.users if user.voting]
+    def expire_session(self, session_id):
+        logger.info("session expired: %s", session_id)
 
-    async def purge_inactive_sessions(self, user=None):
-        to_remove = set()
+        # records follow the change, a snapshot written by record() has to include it
+        self.remove_session(session_id)
+        self.record("expire", session=session_id)
 
-        for session_id, session in self.sessions_by_id.items():
-            if user and session.user != user:
-                continue
+    def remove_session(self, session_id):
+        room, session = self.get_session(session_id)
 
-            if not session.active:
-                session.user.sessions.remove(session)
-                to_remove.add(session_id)
+        room.remove_session(session)
+        del self.rooms_by_session_id[session_id]
 
-        for session_id in to_remove:
-            del self.sessions_by_id[session_id]
+        if not session.user.sessions:
+            room.remove_user(session.user)
+
+        if room.empty:
+            logger.info("closing room: %s", room.id)
+            del self.rooms_by_id[room.id]
+            self.history.close_room(room.id)
 
     async def create_session(self, session_id, session_data):
         try:
             identity = self.identity_signer.unsign_identity(session_data.get("identity", ""))
-        except AssertionError:
+        except (AssertionError, InvalidPayload, InvalidSignature):
             logger.debug("error loading identity for session %s: %s", session_id, session_data)
             await self.notification_service.publish(session_id, self.Events.NO_IDENTITY_FOUND)
             raise IdentityError("error loading identity for session %s" % session_id)
 
-        try:
-            user = self.find_user_by_remote_id(identity.id)
-        except ValueError:
-            user = IdentityUser(identity=identity)
-            self.users.append(user)
+        room = self.get_room(session_data.get("room") or self.DEFAULT_ROOM_ID)
+        session = self.add_session(room, session_id, identity)
+        self.record("session", room=room.id, session=session_id, identity=dump_identity(identity))
 
-        session = Session(id=session_id, user=user)
-        user.sessions.append(session)
-        self.sessions_by_id[session.id] = session
-
-        return session
+        return room, session
 
     async def on_connected(self, session_id, session_data):
         logger.info("connecting session: %s", session_id)
 
         try:
-            session = self.sessions_by_id[session_id]
-            session.connected = True
+            room, session = self.get_session(session_id)
         except KeyError:
-            session = await self.create_session(session_id, session_data)
+            room, session = await self.create_session(session_id, session_data)
             await self.notification_service.publish(session.id, self.Events.LOGGED_OUT_USER)
+        else:
+            session.connected = True
+            self.session_expiry.cancel(session_id)
+
+            if "last_seq" in session_data:
+                await self.resume_session(room, session, session_data["last_seq"])
+
+        await self.update_user(room, session.user)
+
+    async def resume_session(self, room, session, last_seq):
+        # last_seq comes from the client, anything but a sequence number gets a snapshot
+        if isinstance(last_seq, int) and not isinstance(last_seq, bool):
+            missed_events = room.events_since(last_seq)
+        else:
+            missed_events = None
+
+        if missed_events is None:
+            logger.debug("session %s is too far behind, sending a snapshot", session.id)
+            await self.notification_service.publish(session.id, self.Events.ROOM_SNAPSHOT, self.snapshot(room, session), seq=room.seq)
+            return
+
+        logger.debug("replaying %d events to session %s", len(missed_events), session.id)
+
+        for room_event in missed_events:
+            if not room_event.session_type & session.session_type:
+                continue
+
+            if room_event.user and room_event.user is not session.user:
+                continue
+
+            await self.notification_service.publish(session.id, room_event.event, *room_event.args, seq=room_event.seq)
 
-        await self.purge_inactive_sessions(session.user)
-        await self.update_user(session.user)
+    def snapshot(self, room, session):
+        return {
+            "seq": room.seq,
+            "scores_revealed": room.scores_revealed,
+            "users": list(room.voters) if session.user.hosting else [session.user]
+        }
 
     async def on_disconnected(self, session_id):
         logger.info("disconnecting session: %s", session_id)
 
-        session = self.sessions_by_id[session_id]
+        try:
+            room, session = self.get_session(session_id)
+        except KeyError:
+            # on_connected failed before the session was created
+            logger.debug("unknown session disconnected: %s", session_id)
+            return
+
         session.connected = False
         session.last_seen = datetime.now()
+        self.session_expiry.schedule(session_id)
 
-        await self.update_user(session.user)
+        await self.update_user(room, session.user)
 
-    async def notify(self, event, *args, session_type=SessionType.HOST | SessionType.VOTER, user=None):
-        for session in self.sessions_by_id.values():
+    async def notify(self, room, event, *args, session_type=SessionType.HOST | SessionType.VOTER, user=None):
+        if room.pending_updates:
+            await self.flush_user_updates(room)
+
+        started = time.perf_counter()
+        session_ids = []
+
+        for session in (user.sessions if user else room.sessions_of_type(session_type)):
             if not(session.connected and session.session_type & session_type):
                 continue
 
-            if user and session.user is not user:
-                continue
+            session_ids.append(session.id)
+
+        seq = room.log_event(session_type, user, event, args)
 
-            logger.debug("sending \"%s\" to %s with %s", event, session.id, args)
-            await self.notification_service.publish(session.id, event, *args)
+        logger.debug("sending \"%s\" (%d) to %s with %s", event, seq, session_ids, args)
+        await self.notification_service.broadcast(session_ids, event, *args, seq=seq)
 
-    async def notify_hosts(self, event, *args):
+        self.notify_duration.observe(time.perf_counter() - started, event)
+        self.notify_fanout.observe(len(session_ids), event)
+        count_fanout(len(session_ids))
+
+    async def notify_hosts(self, room, event, *args):
         logger.debug("notify hosts: %s (%s)", event, args)
-        await self.notify(event, *args, session_type=SessionType.HOST)
+        await self.notify(room, event, *args, session_type=SessionType.HOST)
+
+    async def update_user(self, room, user, **kwargs):
+        logging.debug("updating user %s: %s", user.id, user.wire)
 
-    async def update_user(self, user, **kwargs):
-        logging.debug("updating user %s: %s", user.id, str(dict(user)))
+        with room.tracking(user):
+            for name, value in kwargs.items():
+                setattr(user, name, value)
 
-        for name, value in kwargs.items():
-            setattr(user, name, value)
+        if self.update_batch_delay is None:
+            await self.notify(room, self.Events.PROFILE_UPDATED, user, session_type=SessionType.ANY, user=user)
 
-        await self.notify(self.Events.PROFILE_UPDATED, user, session_type=SessionType.ANY, user=user)
+            if user.voting:
+                await self.notify_hosts(room, self.Events.UPDATED_USER, user)
+
+            return
 
-        if user.voting:
-            await self.notify_hosts(self.Events.UPDATED_USER, user)
+        room.pending_updates[user.id] = user
+
+        if not room.updates_flush:
+            room.updates_flush = asyncio.create_task(self.flush_user_updates_later(room))
+
+    async def flush_user_updates_later(self, room):
+        await asyncio.sleep(self.update_batch_delay)
+
+        room.updates_flush = None
+        await self.flush_user_updates(room)
+
+    async def flush_user_updates(self, room):
+        users = list(room.pending_updates.values())
+        room.pending_updates.clear()
+
+        for user in users:
+            await self.notify(room, self.Events.PROFILE_UPDATED, user, session_type=SessionType.ANY, user=user)
+
+        voters = [user for user in users if user.voting]
+        if voters:
+            await self.notify_hosts(room, self.Events.USERS_UPDATED, voters)
 
     async def login_voter(self, session_id):
-        session = self.sessions_by_id[session_id]
-        session.session_type = SessionType.VOTER
+        room, session = self.get_session(session_id)
+        self.set_session_type(room, session, SessionType.VOTER)
 
-        await self.notification_service.publish(session_id, self.Events.LOGGED_IN_VOTER, not self.scores_revealed)
-        await self.notify_hosts(self.Events.JOINED_MEETING, session.user)
+        await self.notification_service.publish(session_id, self.Events.LOGGED_IN_VOTER, not room.scores_revealed)
+        await self.notify_hosts(room, self.Events.JOINED_MEETING, session.user)
 
         logger.info("client %s registered as a voter with username %s", session_id, session.user.name)
 
     async def login_host(self, session_id):
-        session = self.sessions_by_id[session_id]
-        session.session_type = session.session_type = SessionType.HOST
+        room, session = self.get_session(session_id)
+        self.set_session_type(room, session, SessionType.HOST)
 
         if not session.user.can_host:
             raise PermissionsError("not allowed")
@@ -155,73 +375,91 @@ class PokerService:
         await self.notification_service.publish(session_id, self.Events.LOGGED_IN_HOST)
         logger.info("client %s joined as host", session_id)
 
-        await self.purge_inactive_sessions()
-
-        for user in self.users:
-            if user.active and user.voting:
-                await self.notification_service.publish(session_id, self.Events.JOINED_MEETING, user)
+        for user in room.voters:
+            await self.notification_service.publish(session_id, self.Events.JOINED_MEETING, user)
 
     async def logout_user(self, session_id):
-        session = self.sessions_by_id[session_id]
+        room, session = self.get_session(session_id)
         was_voting = session.user.voting
 
         for session in session.user.sessions:
-            session.session_type = SessionType.NONE
+            self.set_session_type(room, session, SessionType.NONE)
 
-        await self.notify(self.Events.LOGGED_OUT_USER, session_type=SessionType.ANY, user=session.user)
+        await self.notify(room, self.Events.LOGGED_OUT_USER, session_type=SessionType.ANY, user=session.user)
 
         if was_voting:
-            await self.notify_hosts(self.Events.LEFT_MEETING, session.user)
+            await self.notify_hosts(room, self.Events.LEFT_MEETING, session.user)
 
         logger.info("logged out: %s", session_id)
 
     async def new_target(self, session_id):
-        session = self.sessions_by_id[session_id]
+        room, session = self.get_session(session_id)
         if not session.user.hosting:
             raise PermissionsError("you are not a host")
 
-        self.scores_revealed = False
-
-        for user in self.users:
-            user.score = 0
+        room.scores_revealed = False
+        room.reset_scores()
+        room.target_started_at = time.time()
+        room.history_round = None
+        self.record("new_target", room=room.id)
 
-        await self.notify(self.Events.NEW_TARGET)
+        await self.notify(room, self.Events.NEW_TARGET)
 
     async def estimate_target(self, session_id, score):
-        user = self.sessions_by_id[session_id].user
+        room, session = self.get_session(session_id)
         logger.info("score received from %s: %s", session_id, score)
 
-        if self.scores_revealed:
+        if room.scores_revealed:
             logger.info("the scores are already revealed, ignoring")
             return
 
-        await self.update_user(user, score=score)
+        # the score is recorded before anything awaits, so no other record can come between them
+        with room.tracking(session.user):
+            session.user.score = score
 
-        if all(self.get_scores()):
-            await self._reveal_scores()
+        self.record("score", session=session_id, score=score)
+        await self.update_user(room, session.user)
+
+        if not room.pending_scores:
+            await self._reveal_scores(room)
 
     async def reveal_scores(self, session_id):
-        session = self.sessions_by_id[session_id]
+        room, session = self.get_session(session_id)
         if not session.user.hosting:
             raise PermissionsError("you are not a host")
 
-        await self._reveal_scores()
+        await self._reveal_scores(room)
+
+    async def get_history(self, session_id, before=None, limit=20):
+        room, session = self.get_session(session_id)
+        if not session.user.hosting:
+            raise PermissionsError("you are not a host")
+
+        page = self.history.page(room.id, before, limit)
+        await self.notification_service.publish(session_id, self.Events.HISTORY_PAGE, page)
+
+    async def history_page(self, room_id, before=None, limit=20):
+        return self.history.page(room_id or self.DEFAULT_ROOM_ID, before, limit)
+
+    async def _reveal_scores(self, room):
+        logger.info("revealing scores in room %s", room.id)
 
-    async def _reveal_scores(self):
-        logger.info("revealing scores")
+        room.scores_revealed = True
+        self.record("reveal", room=room.id)
 
-        self.scores_revealed = True
-        scores = sorted(filter(lambda x: x > 0, self.get_scores()))
+        votes = [(user.remote_id, user.name, user.score) for user in room.voters if user.score > 0]
+        entry = self.history.add_round(room.id, room.target_started_at, time.time(), votes, room.history_round)
+        room.history_round = entry["round"]
 
-        await self.notify(self.Events.SCORES_REVEALED)
+        await self.notify(room, self.Events.SCORES_REVEALED)
 
-        if scores:
+        if votes:
             msg = "scores: %s\nmean: %.2f\nmedian: %.2f" % (
-                ", ".join([str(score) for score in scores]),
-                statistics.mean(scores),
-                statistics.median(scores)
+                ", ".join([str(score) for score in sorted(score for _, _, score in votes)]),
+                entry["mean"],
+                entry["median"]
             )
         else:
             msg = "no votes"
 
-        await self.notify_hosts(self.Events.LOG_MESSAGE_SENT, msg)
+        await self.notify_hosts(room, self.Events.LOG_MESSAGE_SENT, msg)
@@ -0,0 +1,117 @@
+import asyncio
+import collections
+import contextvars
+import logging
+import os.path
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# sessions reached by the events of the rpc call being handled, see WebSocketRPCProtocol.call
+rpc_fanout = contextvars.ContextVar("rpc_fanout", default=None)
+
+
+def count_fanout(sessions):
+    counter = rpc_fanout.get()
+
+    if counter is not None:
+        counter[0] += sessions
+
+
+def describe_handle(handle):
+    # task steps are reported by their task like asyncio debug mode does
+    task = getattr(handle._callback, "__self__", None)
+
+    return repr(task) if isinstance(task, asyncio.Task) else repr(handle)
+
+
+def slow_callback_detection(slow_callback_duration):
+    async def enable(app):
+        # times every callback or task step without asyncio debug mode and its overhead
+        run = asyncio.events.Handle._run
+
+        if getattr(run, "slow_callback_duration", None) is not None:
+            run = run.wrapped
+
+        def timed_run(handle):
+            started = time.perf_counter()
+            run(handle)
+            duration = time.perf_counter() - started
+
+            if duration >= slow_callback_duration:
+                logger.warning("executing %s took %.3f seconds", describe_handle(handle), duration)
+
+        timed_run.wrapped = run
+        timed_run.slow_callback_duration = slow_callback_duration
+        asyncio.events.Handle._run = timed_run
+
+        logger.warning("slow callback detection enabled, threshold %.3fs", slow_callback_duration)
+
+    return enable
+
+
+class SamplingProfiler:
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.thread = None
+        self.stopping = threading.Event()
+        self.started_at = None
+        self.duration = 0
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    @property
+    def status(self):
+        return {
+            "running": self.running,
+            "interval": self.interval,
+            "samples": sum(self.samples.values()),
+            "duration": time.monotonic() - self.started_at if self.running else self.duration,
+        }
+
+    def start(self, thread_id=None):
+        if self.running:
+            return
+
+        self.samples.clear()
+        self.stopping.clear()
+        self.started_at = time.monotonic()
+        self.thread = threading.Thread(
+            target=self.sample,
+            args=(thread_id or threading.get_ident(),),
+            name="profiler",
+            daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        self.duration = time.monotonic() - self.started_at
+
+    def sample(self, thread_id):
+        while not self.stopping.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+
+            while frame:
+                code = frame.f_code
+                stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def render(self):
+        # "collapsed stacks", the input format of flamegraph.pl and speedscope
+        return "".join("%s %d\n" % (stack, count) for stack, count in self.samples.most_common())
@@ -0,0 +1,158 @@
+import gzip
+import logging
+import mimetypes
+import os
+import re
+import time
+from hashlib import blake2b
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import aiohttp.web
+
+logger = logging.getLogger(__name__)
+
+
+class StaticAsset:
+
+    def __init__(self, body, content_type, cache_control):
+        self.content_type = content_type
+        self.charset = "utf-8" if content_type.startswith("text/") else None
+        self.cache_control = cache_control
+        self.etag = blake2b(body, digest_size=16).hexdigest()
+        # encoding -> (body, etag), every encoding needs its own strong etag
+        self.variants = {"identity": (body, '"%s"' % self.etag)}
+
+    def add_variant(self, encoding, body):
+        if len(body) < len(self.variants["identity"][0]):
+            self.variants[encoding] = (body, '"%s-%s"' % (self.etag, encoding))
+
+
+class StaticAssets:
+    # most preferred first
+    ENCODINGS = ("br", "gzip")
+    COMPRESSIBLE_TYPES = re.compile(r"^(text/.*|application/(javascript|json|wasm|xml)|image/svg\+xml)$")
+    # files with a content hash in their name never change
+    HASHED_NAME = re.compile(r"[.-][0-9a-f]{8,}\.")
+    IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+    REVALIDATE_CACHE_CONTROL = "no-cache"
+    MIN_COMPRESS_SIZE = 1024
+
+    def __init__(self):
+        self.assets = {}
+
+    @property
+    def encodings(self):
+        return [encoding for encoding in self.ENCODINGS if encoding != "br" or brotli]
+
+    def load_directory(self, directory, prefix=""):
+        started = time.perf_counter()
+
+        for root, dirs, files in os.walk(directory):
+            for filename in files:
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, directory).replace(os.sep, "/")
+
+                if filename.startswith(".") or os.path.splitext(filename)[1] in (".gz", ".br"):
+                    continue
+
+                self.load_file(prefix + name, path)
+
+        logger.info("loaded %d static assets from %s in %.2fs", len(self.assets), directory, time.perf_counter() - started)
+
+    def load_file(self, name, path, **kwargs):
+        kwargs.setdefault("content_type", mimetypes.guess_type(path)[0])
+
+        with open(path, "rb") as f:
+            return self.add(name, f.read(), path=path, **kwargs)
+
+    def add(self, name, body, content_type=None, cache_control=None, path=None):
+        content_type = content_type or mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+        if not cache_control:
+            hashed = self.HASHED_NAME.search(os.path.basename(name))
+            cache_control = self.IMMUTABLE_CACHE_CONTROL if hashed else self.REVALIDATE_CACHE_CONTROL
+
+        asset = self.assets[name] = StaticAsset(body, content_type, cache_control)
+
+        if len(body) < self.MIN_COMPRESS_SIZE or not self.COMPRESSIBLE_TYPES.match(content_type):
+            return asset
+
+        for encoding in self.encodings:
+            asset.add_variant(encoding, self.precompressed(path, encoding) or self.compress(body, encoding))
+
+        return asset
+
+    def precompressed(self, path, encoding):
+        # files compressed at build time, e.g. "chpoker-qt.wasm.br", take precedence
+        if not path:
+            return None
+
+        try:
+            with open("%s.%s" % (path, "br" if encoding == "br" else "gz"), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def compress(self, body, encoding):
+        if encoding == "br":
+            return brotli.compress(body)
+
+        return gzip.compress(body, compresslevel=9, mtime=0)
+
+    def accepted_encodings(self, request):
+        accepted = {}
+
+        for item in request.headers.get("Accept-Encoding", "").split(","):
+            encoding, _, params = item.strip().partition(";")
+            quality = 1.0
+
+            if params.strip().startswith("q="):
+                try:
+                    quality = float(params.strip()[2:])
+                except ValueError:
+                    pass
+
+            accepted[encoding.strip().lower()] = quality
+
+        return accepted
+
+    def select_variant(self, request, asset):
+        accepted = self.accepted_encodings(request)
+
+        for encoding in self.ENCODINGS:
+            if encoding in asset.variants and accepted.get(encoding, accepted.get("*", 0)) > 0:
+                return encoding
+
+        return "identity"
+
+    def response(self, request, name):
+        try:
+            asset = self.assets[name]
+        except KeyError:
+            raise aiohttp.web.HTTPNotFound()
+
+        encoding = self.select_variant(request, asset)
+        body, etag = asset.variants[encoding]
+
+        headers = {
+            "ETag": etag,
+            "Cache-Control": asset.cache_control,
+            "Vary": "Accept-Encoding",
+        }
+
+        if_none_match = [tag.strip().removeprefix("W/") for tag in request.headers.get("If-None-Match", "").split(",")]
+
+        if etag in if_none_match or "*" in if_none_match:
+            return aiohttp.web.Response(status=304, headers=headers)
+
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+
+        return aiohttp.web.Response(body=body, content_type=asset.content_type, charset=asset.charset, headers=headers)
+
+    async def handle(self, request):
+        return self.response(request, request.path)
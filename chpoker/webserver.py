@@ -3,28 +3,37 @@ import os.path
 import json
 import logging
 
+from .staticassets import StaticAssets
+
+RESOURCES_DIR = os.path.join(os.path.dirname(__file__), "resources")
+
+
+def load_static_assets():
+    static_assets = StaticAssets()
+    static_assets.load_file("/", os.path.join(RESOURCES_DIR, "index.html"))
+    static_assets.load_directory(os.path.join(RESOURCES_DIR, "static"), prefix="/static/")
+
+    return static_assets
+
 
 class WebServer:
 
-    def __init__(self):
+    def __init__(self, static_assets=None):
         self.app = aiohttp.web.Application()
+        self.static_assets = static_assets or load_static_assets()
 
-        self.app.router.add_get("/", self.index_handler)
-        self.app.router.add_static("/static", os.path.join(os.path.dirname(__file__), "resources", "static"))
+        self.app.router.add_get("/", self.static_assets.handle)
+        self.app.router.add_get("/static/{name:.+}", self.static_assets.handle)
 
         self.next_client_id = 0
 
     def add_protocol(self, name, handler):
         self.app.router.add_get("/%s" % name, handler.connect)
 
+    def add_metrics(self, metrics):
+        self.app.router.add_get("/metrics", metrics.handle)
+        self.app.on_startup.append(metrics.start)
+        self.app.on_cleanup.append(metrics.stop)
+
     def run(self, **kwargs):
         aiohttp.web.run_app(self.app, **kwargs)
-
-    async def index_handler(self, request):
-        with open(os.path.join(os.path.dirname(__file__), "resources", "index.html")) as file:
-            content = file.read()
-
-        return aiohttp.web.Response(
-            content_type = "text/html",
-            text = content
-        )
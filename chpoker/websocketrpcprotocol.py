@@ -1,45 +1,294 @@
-import json
+import asyncio
+import collections
 import logging
+import time
 import uuid
+from enum import StrEnum, auto, unique
 
 import aiohttp.web
 
-from .jsonencoder import JSONEncoder
+from .messagecodec import JSONCodec, MsgpackCodec, msgpack
+from .metrics import Metrics
+from .profiling import rpc_fanout
 
 logger = logging.getLogger(__name__)
 
 
+class RPCError(Exception):
+    pass
+
+
+class RateLimitError(RPCError):
+    pass
+
+
+@unique
+class OverflowPolicy(StrEnum):
+    DROP = auto()
+    COALESCE = auto()
+
+
+async def send_frame(socket, message):
+    if isinstance(message, bytes):
+        await socket.send_bytes(message)
+    else:
+        await socket.send_str(message)
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.updated_at) * self.rate, self.burst)
+        self.updated_at = now
+
+        if self.tokens < 1:
+            return False
+
+        self.tokens -= 1
+        return True
+
+
+class ClientConnection:
+
+    def __init__(self, client_id, socket, codec, send_timeout, room_id=None):
+        self.client_id = client_id
+        self.room_id = room_id
+        self.socket = socket
+        self.codec = codec
+        self.send_timeout = send_timeout
+        self.rate_limits = {}
+        self.queue = collections.deque()
+        self.queue_ready = asyncio.Event()
+        self.writer = None
+        self.closer = None
+
+    @property
+    def closing(self):
+        return self.closer is not None
+
+    def start(self, on_send_error):
+        self.writer = asyncio.create_task(self.write_messages(on_send_error))
+
+    def stop(self):
+        if self.writer:
+            self.writer.cancel()
+
+        self.queue.clear()
+
+    def close(self, code):
+        if self.closing:
+            return
+
+        self.queue.clear()
+        self.closer = asyncio.create_task(self.socket.close(code=code))
+
+    def enqueue(self, message, coalesce_key=None):
+        self.queue.append([coalesce_key, message])
+        self.queue_ready.set()
+
+    def coalesce(self, message, coalesce_key):
+        # the newer event goes out after everything queued before it
+        for item in self.queue:
+            if item[0] == coalesce_key:
+                self.queue.remove(item)
+                self.queue.append([coalesce_key, message])
+                return True
+
+        return False
+
+    async def write_messages(self, on_send_error):
+        while True:
+            while not self.queue:
+                self.queue_ready.clear()
+                await self.queue_ready.wait()
+
+            _, message = self.queue.popleft()
+
+            try:
+                await asyncio.wait_for(send_frame(self.socket, message), self.send_timeout)
+            except Exception as e:
+                await on_send_error(self, e)
+                return
+
+
 class WebSocketRPCProtocol:
+    # clients without a room end up in this one, the same as PokerService.DEFAULT_ROOM_ID
+    DEFAULT_ROOM_ID = "default"
 
-    def __init__(self):
+    def __init__(self, send_queue_size=256, send_timeout=10, overflow_policy=OverflowPolicy.DROP, metrics=None,
+                 slow_rpc_threshold=None, max_connections=None, max_room_connections=None, max_message_size=65536,
+                 rate_limits=None, heartbeat_interval=30, handshake_timeout=10):
         self.service_container = {}
         self.service_allowed_methods = {}
+        self.service_events = {}
         self.disconnect_handlers = {}
         self.clients_by_id = {}
+        self.codecs = {None: JSONCodec()}
+
+        self.send_queue_size = send_queue_size
+        self.send_timeout = send_timeout
+        self.overflow_policy = OverflowPolicy(overflow_policy)
+        self.slow_rpc_threshold = slow_rpc_threshold
+        self.max_connections = max_connections
+        self.max_room_connections = max_room_connections
+        self.max_message_size = max_message_size
+        # method name, or "*" for all others, to (calls per second, burst)
+        self.rate_limits = rate_limits or {}
+        # aiohttp pings every interval and closes sockets without a pong within half of it
+        self.heartbeat_interval = heartbeat_interval or None
+        # seconds a new socket may take to send its hello message, it holds a connection slot until then
+        self.handshake_timeout = handshake_timeout
+
+        # sockets count from the upgrade, rooms once the hello message named them
+        self.open_connections = 0
+        self.room_connections = collections.Counter()
+
+        self.rejected_connections = 0
+        self.oversized_messages = 0
+        self.heartbeat_timeouts = 0
+        self.handshake_timeouts = 0
+        self.replaced_connections = 0
+        self.dropped_clients = 0
+        self.coalesced_messages = 0
+        self.send_timeouts = 0
+        self.send_failures = 0
+
+        metrics = metrics or Metrics()
+        self.rpc_duration = metrics.histogram("rpc_duration_seconds", "time spent in rpc calls", labels=("service", "method"))
+        self.rpc_errors = metrics.counter("rpc_errors_total", "rpc calls that raised an error", labels=("service", "method"))
+        self.rpc_rate_limited = metrics.counter("rpc_rate_limited_total", "rpc calls rejected by the rate limit",
+                                                labels=("service", "method"))
+
+    @property
+    def queue_depth(self):
+        return sum(len(connection.queue) for connection in self.clients_by_id.values())
+
+    @property
+    def max_queue_depth(self):
+        return max((len(connection.queue) for connection in self.clients_by_id.values()), default=0)
+
+    @property
+    def stats(self):
+        return {
+            "clients": len(self.clients_by_id),
+            "open_connections": self.open_connections,
+            "rejected_connections": self.rejected_connections,
+            "oversized_messages": self.oversized_messages,
+            "heartbeat_timeouts": self.heartbeat_timeouts,
+            "handshake_timeouts": self.handshake_timeouts,
+            "replaced_connections": self.replaced_connections,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "dropped_clients": self.dropped_clients,
+            "coalesced_messages": self.coalesced_messages,
+            "send_timeouts": self.send_timeouts,
+            "send_failures": self.send_failures,
+        }
 
     async def connect(self, request):
-        socket = aiohttp.web.WebSocketResponse()
+        socket = aiohttp.web.WebSocketResponse(protocols=[name for name in self.codecs if name],
+                                               max_msg_size=self.max_message_size,
+                                               heartbeat=self.heartbeat_interval)
         await socket.prepare(request)
 
-        client_id, client_data = await self.handshake(socket)
-        self.clients_by_id[client_id] = socket
+        if self.max_connections is not None and self.open_connections >= self.max_connections:
+            return await self.reject(socket, "server is full")
+
+        self.open_connections += 1
+
+        try:
+            codec = self.codecs.get(socket.ws_protocol, self.codecs[None])
+
+            try:
+                client_id, client_data = await asyncio.wait_for(self.handshake(socket, codec), self.handshake_timeout)
+            except asyncio.TimeoutError:
+                logger.info("closing connection without hello message")
+                self.handshake_timeouts += 1
+                await socket.close(code=aiohttp.WSCloseCode.POLICY_VIOLATION, message=b"no hello message")
+                return socket
+
+            room_id = client_data.get("room") or self.DEFAULT_ROOM_ID
+
+            # a client replacing its own stale socket in the room does not need another place
+            previous = self.clients_by_id.get(client_id)
+            reconnecting = previous is not None and previous.room_id == room_id
+
+            if (self.max_room_connections is not None and not reconnecting
+                    and self.room_connections[room_id] >= self.max_room_connections):
+                return await self.reject(socket, "room is full")
+
+            self.room_connections[room_id] += 1
+
+            try:
+                await self.serve(request, socket, codec, client_id, client_data, room_id)
+            finally:
+                self.room_connections[room_id] -= 1
+
+                if not self.room_connections[room_id]:
+                    del self.room_connections[room_id]
+        finally:
+            self.open_connections -= 1
+
+        return socket
+
+    async def reject(self, socket, reason):
+        logger.warning("rejecting connection: %s", reason)
+        self.rejected_connections += 1
+
+        await socket.close(code=aiohttp.WSCloseCode.TRY_AGAIN_LATER, message=reason.encode())
+        return socket
+
+    async def serve(self, request, socket, codec, client_id, client_data, room_id=None):
+        connection = ClientConnection(client_id, socket, codec, self.send_timeout, room_id)
+        connection.start(self.on_send_error)
+
+        # a client reconnecting with its id means its previous socket is dead, even if no FIN arrived
+        previous = self.clients_by_id.get(client_id)
+        if previous:
+            logger.info("client %s reconnected, closing its previous connection", client_id)
+            self.replaced_connections += 1
+            previous.close(aiohttp.WSCloseCode.GOING_AWAY)
+
+        self.clients_by_id[client_id] = connection
 
         session_data = {
             **request.cookies,
             **client_data
         }
 
-        for service_name, service in self.service_container.items():
-            await service.on_connected(client_id, session_data)
+        connected_services = []
 
-        await self.receive_messages(socket, client_id)
+        try:
+            for service_name, service in self.service_container.items():
+                # a service that fails halfway through connecting still gets to clean up
+                connected_services.append((service_name, service))
+                await service.on_connected(client_id, session_data)
 
-        return socket
+            await self.receive_messages(socket, client_id, codec)
+        finally:
+            connection.stop()
+
+            # a replaced connection leaves the session to its successor
+            if self.clients_by_id.get(client_id) is connection:
+                del self.clients_by_id[client_id]
 
-    async def handshake(self, socket):
+                for service_name, service in connected_services:
+                    try:
+                        await service.on_disconnected(client_id)
+                    except Exception as e:
+                        logger.exception("error disconnecting %s from %s: %s", client_id, service_name, e)
+
+    async def handshake(self, socket, codec):
         async for msg in socket:
-            if msg.type == aiohttp.WSMsgType.text:
-                rpc_body = json.loads(msg.data)
+            if msg.type in (aiohttp.WSMsgType.text, aiohttp.WSMsgType.binary):
+                rpc_body = codec.decode(msg.data)
                 logger.debug("rpc body: %s", rpc_body)
 
                 if rpc_body["type"] != "hello":
@@ -48,10 +297,11 @@ class WebSocketRPCProtocol:
                 client_id = rpc_body.get("client_id", str(uuid.uuid1()))
                 hello_message = {
                     "type": "hello",
-                    "client_id": client_id
+                    "client_id": client_id,
+                    **codec.hello()
                 }
 
-                await socket.send_str(json.dumps(hello_message))
+                await send_frame(socket, codec.encode(hello_message))
                 return client_id, {k: v for k, v in rpc_body.items() if k not in ("type", "client_id")}
 
             elif msg.type == aiohttp.WSMsgType.close:
@@ -59,41 +309,191 @@ class WebSocketRPCProtocol:
 
         raise Exception("no handshake received")
 
-    async def receive_messages(self, socket, client_id):
+    async def receive_messages(self, socket, client_id, codec):
         async for msg in socket:
-            if msg.type == aiohttp.WSMsgType.text:
+            if msg.type in (aiohttp.WSMsgType.text, aiohttp.WSMsgType.binary):
                 try:
-                    message_body = json.loads(msg.data)
-                    if message_body["type"] != "rpc":
-                        raise Exception("unhandled message of type %s" % message_body["type"])
-
-                    rpc_body = message_body["rpc"]
-                    service_name = rpc_body["service"]
-                    method_name = rpc_body["method"]
-                    service = self.service_container[service_name]
+                    message_body = codec.decode(msg.data)
 
-                    if method_name in self.service_allowed_methods[service_name]:
-                        await getattr(service, method_name)(client_id, **rpc_body.get("params", {}))
+                    if message_body["type"] == "rpc":
+                        await self.call(client_id, message_body["rpc"])
+                    elif message_body["type"] == "batch":
+                        await self.call_batch(client_id, message_body["rpcs"])
                     else:
-                        logger.warning("method %s is not allowed for service %s", method_name, service_name)
+                        raise Exception("unhandled message of type %s" % message_body["type"])
                 except Exception as e:
-                    logger.exception(str(e))
+                    self.log_call_error(e)
+            elif msg.type == aiohttp.WSMsgType.error:
+                # aiohttp has already closed the socket with the error's close code
+                if getattr(msg.data, "code", None) == aiohttp.WSCloseCode.MESSAGE_TOO_BIG:
+                    logger.warning("closing client %s: %s", client_id, msg.data)
+                    self.oversized_messages += 1
+                elif isinstance(msg.data, asyncio.TimeoutError):
+                    logger.info("closing client %s: %s", client_id, msg.data)
+                    self.heartbeat_timeouts += 1
             elif msg.type == aiohttp.WSMsgType.close:
                 pass
 
-        for service_name, service in self.service_container.items():
-            await service.on_disconnected(client_id)
+    async def call(self, client_id, rpc_body):
+        service_name = rpc_body["service"]
+        method_name = rpc_body["method"]
+        service = self.service_container[service_name]
+
+        if method_name not in self.service_allowed_methods[service_name]:
+            raise RPCError("method %s is not allowed for service %s" % (method_name, service_name))
+
+        if not self.take_token(client_id, method_name):
+            self.rpc_rate_limited.inc(service_name, method_name)
+            raise RateLimitError("rate limit of %s exceeded by client %s" % (method_name, client_id))
+
+        fanout = [0]
+        fanout_token = rpc_fanout.set(fanout)
+        started = time.perf_counter()
+
+        try:
+            return await getattr(service, method_name)(client_id, **rpc_body.get("params", {}))
+        except Exception:
+            self.rpc_errors.inc(service_name, method_name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            rpc_fanout.reset(fanout_token)
+            self.rpc_duration.observe(elapsed, service_name, method_name)
+
+            if self.slow_rpc_threshold is not None and elapsed > self.slow_rpc_threshold:
+                logger.warning("slow rpc %s.%s from client %s took %.1fms, events sent to %d sessions",
+                               service_name, method_name, client_id, elapsed * 1000, fanout[0])
+
+    def take_token(self, client_id, method_name):
+        try:
+            rate_limits = self.clients_by_id[client_id].rate_limits
+        except KeyError:
+            return True
+
+        try:
+            bucket = rate_limits[method_name]
+        except KeyError:
+            limit = self.rate_limits.get(method_name, self.rate_limits.get("*"))
+
+            if limit is None:
+                return True
+
+            bucket = rate_limits[method_name] = TokenBucket(*limit)
+
+        return bucket.take()
 
-    def register_service(self, service_instance, allowed_methods):
-        service_name = service_instance.__class__.__name__
+    async def call_batch(self, client_id, rpcs):
+        results = []
+
+        for rpc_body in rpcs:
+            started = time.perf_counter()
+            result = {"id": rpc_body.get("id")}
+
+            try:
+                result["result"] = await self.call(client_id, rpc_body)
+            except Exception as e:
+                self.log_call_error(e)
+                # the reason stays in the log, the client only learns whether waiting may help
+                if isinstance(e, RateLimitError):
+                    result["error"] = {"type": "rate_limited", "message": "rate limit exceeded"}
+                else:
+                    result["error"] = {"type": "failed", "message": "rpc call failed"}
+
+            result["elapsed"] = time.perf_counter() - started
+            results.append(result)
+
+        reply = {
+            "type": "batch",
+            "results": results
+        }
+
+        connection = self.clients_by_id[client_id]
+        self.queue_message(connection, connection.codec.encode(reply))
+
+    def log_call_error(self, e):
+        if isinstance(e, RateLimitError):
+            logger.debug(str(e))
+        elif isinstance(e, RPCError):
+            logger.warning(str(e))
+        else:
+            logger.exception(str(e))
+
+    def register_service(self, service_instance, allowed_methods, events=(), service_name=None):
+        service_name = service_name or service_instance.__class__.__name__
         self.service_container[service_name] = service_instance
         self.service_allowed_methods[service_name] = allowed_methods
+        self.service_events[service_name] = list(events)
+
+        if msgpack:
+            self.codecs[MsgpackCodec.subprotocol] = MsgpackCodec(self.service_events)
+
+    def coalesce_key(self, event_data):
+        # events logged for resuming are never replaced, a skipped seq would look like a lost event
+        if "seq" in event_data:
+            return None
+
+        arguments = event_data["arguments"]
+        target_id = getattr(arguments[0], "id", None) if arguments else None
+
+        if target_id is None:
+            return None
+
+        return event_data["service"], event_data["name"], target_id
+
+    def queue_message(self, connection, message, coalesce_key=None):
+        if connection.closing or connection.socket.closed:
+            return
+
+        if len(connection.queue) < self.send_queue_size:
+            connection.enqueue(message, coalesce_key)
+            return
+
+        if self.overflow_policy == OverflowPolicy.COALESCE and coalesce_key:
+            if connection.coalesce(message, coalesce_key):
+                self.coalesced_messages += 1
+                return
+
+        logger.warning("send queue of client %s is full, dropping the client", connection.client_id)
+        self.dropped_clients += 1
+        connection.close(aiohttp.WSCloseCode.TRY_AGAIN_LATER)
+
+    async def on_send_error(self, connection, error):
+        if connection.socket.close_code is not None:
+            logger.debug("client %s closed with events left to send", connection.client_id)
+            return
+
+        if isinstance(error, asyncio.TimeoutError):
+            logger.warning("sending to client %s timed out", connection.client_id)
+            self.send_timeouts += 1
+        else:
+            logger.warning("sending to client %s failed: %s", connection.client_id, error)
+            self.send_failures += 1
+
+        connection.close(aiohttp.WSCloseCode.TRY_AGAIN_LATER)
 
     async def send_event(self, client_id, event_data):
-        socket = self.clients_by_id[client_id]
+        try:
+            connection = self.clients_by_id[client_id]
+        except KeyError:
+            logger.debug("client %s is gone, skipping event", client_id)
+            return
+
+        self.queue_message(connection, connection.codec.encode_event(event_data), self.coalesce_key(event_data))
+
+    async def broadcast_event(self, client_ids, event_data):
+        messages = {}
+        coalesce_key = self.coalesce_key(event_data)
+
+        for client_id in client_ids:
+            try:
+                connection = self.clients_by_id[client_id]
+            except KeyError:
+                logger.debug("client %s is gone, skipping broadcast", client_id)
+                continue
 
-        message = {
-            "type": "event",
-            "event": event_data }
+            try:
+                message = messages[connection.codec]
+            except KeyError:
+                message = messages[connection.codec] = connection.codec.encode_event(event_data)
 
-        await socket.send_str(json.dumps(message, cls = JSONEncoder))
+            self.queue_message(connection, message, coalesce_key)
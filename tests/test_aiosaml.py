@@ -0,0 +1,87 @@
+import asyncio
+import base64
+import functools
+import json
+import shutil
+
+from saml2 import BINDING_HTTP_POST
+from saml2.config import IdPConfig
+from saml2.saml import NAMEID_FORMAT_TRANSIENT
+from saml2.server import Server
+
+from chpoker.aiosaml import AiosamlApplication, ExecutorType, ResponseParser
+from chpoker.cluster import run_workers
+
+IDP_ENTITY_ID = "https://idp.example.com"
+ACS_URL = "http://localhost:8080/acs"
+# nothing is signed, the binary is only looked up
+XMLSEC_BINARY = shutil.which("xmlsec1") or shutil.which("true")
+
+IDP_METADATA = """<md:EntityDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata" entityID="%s">
+  <md:IDPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+    <md:SingleSignOnService Binding="%s" Location="%s/sso"/>
+  </md:IDPSSODescriptor>
+</md:EntityDescriptor>""" % (IDP_ENTITY_ID, BINDING_HTTP_POST, IDP_ENTITY_ID)
+
+SP_METADATA = """<md:EntityDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata" entityID="chpoker">
+  <md:SPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+    <md:AssertionConsumerService Binding="%s" Location="%s" index="0"/>
+  </md:SPSSODescriptor>
+</md:EntityDescriptor>""" % (BINDING_HTTP_POST, ACS_URL)
+
+ATTRIBUTES = {"first_name": ["Ada"], "last_name": ["Lovelace"], "display_name": ["Ada"], "can_moderate": ["true"]}
+
+
+def sp_settings():
+    app = AiosamlApplication(base_url="http://localhost:8080/", idp_metadata_urls=[],
+                             sp_config={"xmlsec_binary": XMLSEC_BINARY})
+    settings = app.saml_settings([IDP_METADATA], [])
+    settings["service"]["sp"]["want_assertions_signed"] = False
+
+    return settings
+
+
+def authn_response():
+    idp = Server(config=IdPConfig().load({
+        "entityid": IDP_ENTITY_ID,
+        "xmlsec_binary": XMLSEC_BINARY,
+        "metadata": {"inline": [SP_METADATA]},
+        "service": {
+            "idp": {
+                "endpoints": {"single_sign_on_service": [(IDP_ENTITY_ID + "/sso", BINDING_HTTP_POST)]},
+                "name_id_format": [NAMEID_FORMAT_TRANSIENT],
+            },
+        },
+    }))
+
+    response = idp.create_authn_response(
+        ATTRIBUTES, in_response_to=None, destination=ACS_URL, sp_entity_id="chpoker", userid="ada",
+        sign_response=False, sign_assertion=False,
+        authn={"class_ref": "urn:oasis:names:tc:SAML:2.0:ac:classes:Password", "authn_auth": IDP_ENTITY_ID})
+
+    return base64.b64encode(str(response).encode()).decode()
+
+
+def parse_in_worker(settings, response, result_path, worker_id):
+    parser = ResponseParser(executor_type=ExecutorType.PROCESS, workers=1)
+    parser.update(None, settings)
+
+    try:
+        _, identity = asyncio.run(parser.parse(response, BINDING_HTTP_POST))
+        result = {"identity": identity}
+    except Exception as e:
+        result = {"error": repr(e)}
+    finally:
+        parser.shutdown()
+
+    with open(result_path, "w") as f:
+        json.dump(result, f)
+
+
+def test_process_pool_parses_in_cluster_worker(tmp_path):
+    result_path = tmp_path / "result.json"
+
+    run_workers(1, functools.partial(parse_in_worker, sp_settings(), authn_response(), result_path))
+
+    with open(result_path) as f:
+        assert json.load(f) == {"identity": ATTRIBUTES}
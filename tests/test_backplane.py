@@ -0,0 +1,108 @@
+import asyncio
+
+from chpoker.backplane import Backplane, BackplaneBroker, encode_command
+
+
+async def start_broker(tmp_path):
+    path = str(tmp_path / "backplane.sock")
+    broker = BackplaneBroker(path)
+    server = asyncio.create_task(broker.serve_forever())
+
+    backplanes = [Backplane("unix://" + path) for _ in range(2)]
+    for backplane in backplanes:
+        await backplane.start()
+
+    return broker, server, backplanes
+
+
+async def stop_broker(server, backplanes):
+    for backplane in backplanes:
+        await backplane.stop()
+
+    server.cancel()
+
+
+async def subscribed(backplane, channel, callback):
+    await backplane.subscribe(channel, callback)
+    # the broker answers subscriptions on the subscriber connection, give it a moment to register
+    await asyncio.sleep(0.1)
+
+
+def test_messages_arrive_in_order(tmp_path):
+    async def run():
+        _, server, (publisher, subscriber) = await start_broker(tmp_path)
+        received = []
+        done = asyncio.Event()
+
+        async def on_message(data):
+            received.append(data)
+
+            if len(received) == 100:
+                done.set()
+
+        await subscribed(subscriber, "chpoker.worker.1", on_message)
+
+        for n in range(100):
+            await publisher.publish("chpoker.worker.1", b"message %d" % n)
+
+        await asyncio.wait_for(done.wait(), 5)
+        await stop_broker(server, (publisher, subscriber))
+
+        return received
+
+    assert asyncio.run(run()) == [b"message %d" % n for n in range(100)]
+
+
+def test_slow_handler_does_not_hold_up_later_messages(tmp_path):
+    async def run():
+        _, server, (publisher, subscriber) = await start_broker(tmp_path)
+        released = asyncio.Event()
+
+        async def on_message(data):
+            # the first message only finishes once the second one has been handled
+            if data == b"slow":
+                await released.wait()
+            else:
+                released.set()
+
+        await subscribed(subscriber, "chpoker.worker.1", on_message)
+        await publisher.publish("chpoker.worker.1", b"slow")
+        await publisher.publish("chpoker.worker.1", b"fast")
+
+        await asyncio.wait_for(released.wait(), 5)
+        await stop_broker(server, (publisher, subscriber))
+
+    asyncio.run(run())
+
+
+def test_broker_disconnects_stalled_subscriber(tmp_path):
+    async def run():
+        broker, server, (publisher, subscriber) = await start_broker(tmp_path)
+        broker.DRAIN_TIMEOUT = 0.2
+        received = asyncio.Event()
+
+        async def on_message(data):
+            received.set()
+
+        await subscribed(subscriber, "chpoker.worker.1", on_message)
+
+        # subscribes and then never reads
+        reader, stalled = await asyncio.open_unix_connection(str(tmp_path / "backplane.sock"))
+        stalled.write(encode_command("SUBSCRIBE", "chpoker.worker.0"))
+        await stalled.drain()
+        await asyncio.sleep(0.1)
+
+        data = b"x" * 65536
+        for _ in range(200):
+            await asyncio.wait_for(publisher.publish("chpoker.worker.0", data), 5)
+
+        assert not broker.subscribers[b"chpoker.worker.0"]
+
+        # the broker still serves everyone else
+        await publisher.publish("chpoker.worker.1", b"still there")
+        await asyncio.wait_for(received.wait(), 5)
+
+        stalled.close()
+        await stop_broker(server, (publisher, subscriber))
+
+    asyncio.run(run())
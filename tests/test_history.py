@@ -0,0 +1,28 @@
+import os
+
+import pytest
+
+from chpoker.history import VoteHistory
+
+VOTES = [("ada", "Ada", 3), ("alan", "Alan", 5), ("grace", "Grace", 8)]
+
+
+@pytest.mark.parametrize("room_id", ["..", ".", "../../etc", "/", ""])
+def test_room_history_stays_in_directory(tmp_path, room_id):
+    directory = tmp_path / "history"
+    history = VoteHistory(str(directory), memory_rounds=2)
+
+    for n in range(5):
+        history.add_round(room_id, n, n + 1, VOTES)
+
+    history.close()
+
+    assert os.listdir(tmp_path) == ["history"]
+
+    for root, _, files in os.walk(directory):
+        for name in files:
+            assert os.path.commonpath([directory, os.path.join(root, name)]) == str(directory)
+
+    page = VoteHistory(str(directory)).page(room_id, limit=10)
+    assert [entry["round"] for entry in page["rounds"]] == [5, 4, 3, 2, 1]
+    assert page["rounds"][0]["votes"][0] == {"user": "ada", "name": "Ada", "score": 3}